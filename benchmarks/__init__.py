@@ -0,0 +1,3 @@
+"""
+Benchmarks for the chat app, run from the repository root with ``python -m benchmarks.<name>``.
+"""
@@ -0,0 +1,398 @@
+"""
+Load test of the whole app, in process: seeds a throwaway database with users,
+friendships, chats and messages, then drives simulated websocket clients and
+REST callers against the FastAPI app. The fake AI backend stands in for
+OpenAI and the in-memory backplane (plus eager Celery tasks) for the broker.
+
+Each scenario prints one JSON line with its throughput, p50/p99 latencies,
+SQL statements per request and the peak RSS of the process so far; --output
+also saves the run as one JSON document, so that two runs can be compared.
+
+    python -m benchmarks.load_test --users 2000 --messages 1000000 --clients 500
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from sqlalchemy import insert
+
+# Importing any chat_app module imports the app, which binds its engines to
+# config.SQLALCHEMY_DATABASE_URL and creates the tables, so chat_app is only
+# imported by main(), once the URL points at the throwaway database.
+
+
+def percentiles(latencies) -> dict:
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"p50_ms": None, "p99_ms": None}
+    return {"p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+            "p99_ms": round(latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000, 2)}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def report(results: list, result: dict):
+    result["peak_rss_mb"] = peak_rss_mb()
+    results.append(result)
+    print(json.dumps(result), flush=True)
+
+
+def seed(engine, users: int, friends: int, messages: int, rng: random.Random,
+         batch_size: int = 50000) -> dict:
+    """
+    Fill an empty database with a synthetic dataset.
+
+    Every user is friends with the next ``friends`` users (wrapping around)
+    and has a chat with each of them; the messages are spread over the chats
+    at random, one second apart.
+
+    Returns:
+    - dict: The chats as (chat_id, user_id, friend_id) tuples, and the time spent.
+    """
+    from chat_app.db import models
+    from chat_app.utils import make_crypt_context
+
+    start = time.perf_counter()
+    # The minimum bcrypt cost, as nothing logs in with these passwords
+    hashed_password = make_crypt_context(4).hash("password")
+    pairs = [(user_id, (user_id - 1 + offset) % users + 1)
+             for user_id in range(1, users + 1) for offset in range(1, friends + 1)]
+    chats = [(chat_id, user_id, friend_id) for chat_id, (user_id, friend_id) in enumerate(pairs, 1)]
+    first_sent_at = datetime.datetime.now() - datetime.timedelta(seconds=messages)
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"id": user_id, "username": f"user{user_id}",
+                                            "hashed_password": hashed_password}
+                                           for user_id in range(1, users + 1)])
+        conn.execute(insert(models.Friend), [{"user_id": user_id, "friend_id": friend_id}
+                                             for user_id, friend_id in pairs])
+        conn.execute(insert(models.Chat), [{"id": chat_id, "user_id": user_id, "friend_id": friend_id}
+                                           for chat_id, user_id, friend_id in chats])
+        for offset in range(0, messages, batch_size):
+            batch = []
+            for n in range(offset, min(offset + batch_size, messages)):
+                chat_id, user_id, friend_id = rng.choice(chats)
+                sent_at = first_sent_at + datetime.timedelta(seconds=n)
+                batch.append({"chat_id": chat_id, "sender_id": rng.choice((user_id, friend_id)),
+                              "message": f"seeded message {n} from the load test",
+                              "created_at": sent_at.strftime("%m/%d/%Y, %H:%M:%S"), "sent_at": sent_at})
+            conn.execute(insert(models.ChatMessage), batch)
+    return {"chats": chats, "seconds": round(time.perf_counter() - start, 2)}
+
+
+class AsgiWebSocket:
+    """
+    WebSocket client talking to an ASGI app directly, without a server or a socket.
+    """
+
+    def __init__(self, app, path: str, query: str = "", cookies: dict = None):
+        self.app = app
+        self.scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "scheme": "ws", "server": ("testserver", 80), "client": ("127.0.0.1", 50000),
+            "root_path": "", "path": path, "raw_path": path.encode(), "query_string": query.encode(),
+            "headers": [(b"host", b"testserver")] + [
+                (b"cookie", "; ".join(f"{name}={value}" for name, value in cookies.items()).encode())
+            ] * bool(cookies),
+            "subprotocols": [],
+        }
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.outgoing: asyncio.Queue = asyncio.Queue()
+        self.close_code = None
+        self._task = None
+
+    async def connect(self) -> bool:
+        """
+        Open the connection.
+
+        Returns:
+        - bool: False if the app closed it instead of accepting it.
+        """
+        self._task = asyncio.create_task(self.app(self.scope, self.incoming.get, self.outgoing.put))
+        await self.incoming.put({"type": "websocket.connect"})
+        event = await self.outgoing.get()
+        if event["type"] == "websocket.close":
+            self.close_code = event.get("code", 1000)
+            return False
+        return event["type"] == "websocket.accept"
+
+    async def send_json(self, data: dict):
+        await self.incoming.put({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def receive_json(self):
+        """
+        Wait for the next message, or return None once the app closed the connection.
+        """
+        event = await self.outgoing.get()
+        if event["type"] == "websocket.close":
+            self.close_code = event.get("code", 1000)
+            return None
+        return json.loads(event["text"] if event.get("text") is not None else event["bytes"])
+
+    async def close(self):
+        await self.incoming.put({"type": "websocket.disconnect", "code": 1000})
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout=5)
+            except Exception:
+                self._task.cancel()
+
+
+async def run_websockets(app, chats, clients: int, messages: int, interval: float, timeout: float) -> dict:
+    """
+    Connect the two members of clients / 2 chats and have every client send messages in its chat.
+
+    Delivery latency is the time from a send to its receipt by each member of the chat.
+    """
+    from chat_app.sessions import COOKIE_NAME, sessions
+    from chat_app.db.base import async_engine, count_queries, engine
+
+    sent_at = {}
+    latencies = []
+    expected = 0
+    delivered = asyncio.Event()
+    chats = chats[:max(1, clients // 2)]
+
+    async def listen(socket: AsgiWebSocket):
+        while True:
+            data = await socket.receive_json()
+            if data is None:
+                return
+            if "db_status" in data and data["message"] in sent_at:
+                latencies.append(time.perf_counter() - sent_at[data["message"]])
+                if len(latencies) >= expected:
+                    delivered.set()
+
+    async def open_socket(user_id: int, chat_id: int):
+        socket = AsgiWebSocket(app, "/ws/chat", f"chat_id={chat_id}",
+                               {COOKIE_NAME: sessions.issue(user_id, f"user{user_id}")})
+        start = time.perf_counter()
+        accepted = await socket.connect()
+        return socket, accepted, time.perf_counter() - start
+
+    async def talk(socket: AsgiWebSocket, user_id: int, chat_id: int):
+        for n in range(messages):
+            text = f"load test {chat_id} {user_id} {n}"
+            sent_at[text] = time.perf_counter()
+            await socket.send_json({"chat_id": chat_id, "sender_id": user_id, "message": text})
+            await asyncio.sleep(interval)
+
+    members = [(user_id, chat_id) for chat_id, user_id, friend_id in chats for user_id in (user_id, friend_id)]
+    start = time.perf_counter()
+    opened = await asyncio.gather(*(open_socket(user_id, chat_id) for user_id, chat_id in members))
+    connect_seconds = time.perf_counter() - start
+    sockets = [(socket, member) for (socket, accepted, _), member in zip(opened, members) if accepted]
+    listeners = [asyncio.create_task(listen(socket)) for socket, _ in sockets]
+    # Rejected connections are accepted, then closed straight away
+    await asyncio.sleep(0.1)
+    sockets = [(socket, member) for socket, member in sockets if socket.close_code is None]
+    # Every message is delivered to the sender and the other member, when both got in
+    connected = {}
+    for _, (user_id, chat_id) in sockets:
+        connected[chat_id] = connected.get(chat_id, 0) + 1
+    expected = sum(messages * count * count for count in connected.values())
+    with ExitStack() as stack:
+        queries = stack.enter_context(count_queries(engine))
+        async_queries = stack.enter_context(count_queries(async_engine.sync_engine))
+        start = time.perf_counter()
+        await asyncio.gather(*(talk(socket, user_id, chat_id) for socket, (user_id, chat_id) in sockets))
+        try:
+            await asyncio.wait_for(delivered.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - start
+    for socket, _ in sockets:
+        await socket.close()
+    for listener in listeners:
+        listener.cancel()
+    sent = messages * len(sockets)
+    return dict({
+        "scenario": "websocket",
+        "clients": len(members),
+        "accepted": len(sockets),
+        "rejected": len(members) - len(sockets),
+        "connect_seconds": round(connect_seconds, 3),
+        "accept_latency": percentiles([seconds for _, _, seconds in opened]),
+        "messages_sent": sent,
+        "deliveries": len(latencies),
+        "deliveries_expected": expected,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(sent / elapsed, 1),
+        "deliveries_per_sec": round(len(latencies) / elapsed, 1),
+        "queries_per_message": round((queries.count + async_queries.count) / sent, 2) if sent else None,
+    }, **percentiles(latencies))
+
+
+# REST calls of a user, by name: functions of (user_id, chat_id) returning the path to GET
+REST_CALLS = {
+    "chat_overview": lambda user_id, chat_id: "/api/chats/overview",
+    "chat_history": lambda user_id, chat_id: f"/api/chats/{chat_id}/messages?limit=50",
+    "chat_history_since": lambda user_id, chat_id: f"/api/chats/{chat_id}/messages?limit=50&since=2000-01-01",
+    "search": lambda user_id, chat_id: "/api/messages/search?q=seeded&order=recent",
+    "friends": lambda user_id, chat_id: f"/api/users/{user_id}/friends",
+    "home_page": lambda user_id, chat_id: "/",
+    "chat_page": lambda user_id, chat_id: f"/{chat_id}",
+}
+
+
+async def run_rest(app, chats, name: str, callers: int, requests: int) -> dict:
+    """
+    Have callers users GET one endpoint concurrently, requests times in total.
+    """
+    import httpx
+    from chat_app.sessions import COOKIE_NAME, sessions
+    from chat_app.db.base import async_engine, count_queries, engine
+
+    latencies, errors = [], 0
+    remaining = requests
+
+    async def call(chat_id: int, user_id: int):
+        nonlocal errors, remaining
+        cookies = {COOKIE_NAME: sessions.issue(user_id, f"user{user_id}")}
+        async with httpx.AsyncClient(app=app, base_url="http://testserver", cookies=cookies) as client:
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                response = await client.get(REST_CALLS[name](user_id, chat_id))
+                latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors += 1
+
+    with ExitStack() as stack:
+        queries = stack.enter_context(count_queries(engine))
+        async_queries = stack.enter_context(count_queries(async_engine.sync_engine))
+        start = time.perf_counter()
+        await asyncio.gather(*(call(chat_id, user_id) for chat_id, user_id, _ in chats[:callers]))
+        elapsed = time.perf_counter() - start
+    return dict({
+        "scenario": "rest",
+        "endpoint": name,
+        "callers": min(callers, len(chats)),
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "queries_per_request": round((queries.count + async_queries.count) / len(latencies), 2),
+    }, **percentiles(latencies))
+
+
+async def run_persistence(chats, mode: str, messages: int, batch_size: int) -> dict:
+    """
+    Push messages through the write-behind writer, as the websocket handler does, until they are saved.
+    """
+    from chat_app.persistence import MessageWriter
+    from chat_app.db.base import count_queries, engine
+
+    writer = MessageWriter(mode=mode, batch_size=batch_size)
+    writer.start()
+    latencies = []
+    with count_queries(engine) as queries:
+        start = time.perf_counter()
+        for n in range(messages):
+            chat_id, user_id, _ = chats[n % len(chats)]
+            now = datetime.datetime.now()
+            submit_start = time.perf_counter()
+            await writer.submit({"sender_id": user_id, "chat_id": chat_id, "message": f"persisted {n}",
+                                 "created_at": now.strftime("%m/%d/%Y, %H:%M:%S"), "sent_at": now.isoformat()})
+            latencies.append(time.perf_counter() - submit_start)
+        await writer.stop()
+        elapsed = time.perf_counter() - start
+    return dict({
+        "scenario": "persistence",
+        "mode": mode,
+        "messages": writer.written,
+        "batches": writer.batches,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(writer.written / elapsed, 1),
+        "queries_per_batch": round(queries.count / writer.batches, 2) if writer.batches else None,
+    }, **{f"submit_{key}": value for key, value in percentiles(latencies).items()})
+
+
+async def run(args, chats, results: list):
+    from chat_app.main import app
+
+    await app.router.startup()
+    try:
+        report(results, await run_websockets(app, chats, args.clients, args.messages_per_client,
+                                             args.interval, args.timeout))
+        for name in args.endpoints:
+            report(results, await run_rest(app, chats, name, args.callers, args.requests))
+        for mode in ("asyncio", "celery"):
+            report(results, await run_persistence(chats, mode, args.persisted_messages, args.batch_size))
+    finally:
+        await app.router.shutdown()
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--friends", type=int, default=5, help="friends (and chats) per user")
+    parser.add_argument("--messages", type=int, default=1000000, help="messages seeded")
+    parser.add_argument("--clients", type=int, default=500, help="websocket clients")
+    parser.add_argument("--messages-per-client", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between the messages of a client")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the last deliveries")
+    parser.add_argument("--callers", type=int, default=50, help="concurrent REST callers")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per REST endpoint")
+    parser.add_argument("--endpoints", nargs="+", choices=list(REST_CALLS), default=list(REST_CALLS))
+    parser.add_argument("--persisted-messages", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=200, help="write-behind batch size")
+    parser.add_argument("--ai-latency", type=float, default=0.0, help="seconds per fake AI rewrite")
+    parser.add_argument("--no-ai", action="store_true", help="send messages without rewriting them")
+    parser.add_argument("--profile", choices=["wal", "default"], default="wal", help="SQLite storage profile")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["CHAT_APP_DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'load_test.db')}"
+        os.environ["CHAT_APP_SQLITE_PROFILE"] = args.profile
+        from chat_app.db import migrations
+        from chat_app.db.base import engine
+        dataset = seed(engine, args.users, args.friends, args.messages, random.Random(args.seed))
+        results = []
+        report(results, {"scenario": "seed", "users": args.users, "chats": len(dataset["chats"]),
+                         "messages": args.messages, "seconds": dataset["seconds"]})
+
+        # Derived data of the seeded rows: chat summaries and read states
+        start = time.perf_counter()
+        migrations.upgrade(engine)
+        report(results, {"scenario": "upgrade", "seconds": round(time.perf_counter() - start, 2)})
+
+        from chat_app.rewrite import FakeBackend, rewriter
+        from chat_app.tasks import celery
+        rewriter.backend = FakeBackend(latency=args.ai_latency)
+        rewriter.enabled = not args.no_ai
+        # Batches handed to Celery are written in process instead of through the broker
+        celery.conf.task_always_eager = True
+
+        rng = random.Random(args.seed)
+        chats = rng.sample(dataset["chats"], len(dataset["chats"]))
+        asyncio.run(run(args, chats, results))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"revision": git_revision(), "arguments": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
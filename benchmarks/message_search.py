@@ -0,0 +1,145 @@
+"""
+Message search on a synthetic corpus: the FTS5 index against a LIKE scan.
+
+Builds a database of random messages drawn from a Zipf-distributed
+vocabulary, times the bulk reindex, the cost of the index triggers on
+inserts, and the latency of scoped searches for rare, common and prefix terms.
+
+    python -m benchmarks.message_search --messages 2000000 --chats 20000
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from sqlalchemy import insert, text
+from sqlalchemy.orm import Session
+from chat_app.db import fts, models
+from chat_app.db.base import Base, make_engine
+
+
+def make_vocabulary(size: int, rng: random.Random):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    words = sorted(words)
+    rng.shuffle(words)
+    # Cumulative, so that drawing a word does not sum the weights every time
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(size)))
+    return words, weights
+
+
+def generate(count: int, chats, words, weights, rng: random.Random, start_id: int = 1):
+    for message_id in range(start_id, start_id + count):
+        chat = rng.choice(chats)
+        yield {"id": message_id, "chat_id": chat["id"], "sender_id": chat[rng.choice(("user_id", "friend_id"))],
+               "message": " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(3, 20))),
+               "created_at": "01/01/2023, 00:00:00"}
+
+
+def insert_messages(engine, rows, batch_size: int = 50000) -> float:
+    start = time.perf_counter()
+    batch = []
+    with engine.begin() as conn:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                conn.execute(insert(models.ChatMessage), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(models.ChatMessage), batch)
+    return time.perf_counter() - start
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {"p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2)}
+
+
+def time_queries(engine, queries, users, search) -> dict:
+    latencies, results = [], 0
+    with Session(engine) as db:
+        for terms in queries:
+            for user_id in users:
+                start = time.perf_counter()
+                results += len(search(db, user_id, terms))
+                latencies.append(time.perf_counter() - start)
+    return dict(percentiles(latencies), queries=len(latencies), results=results)
+
+
+def like_search(db, user_id: int, terms: str, limit: int = 20):
+    # What a search without the index amounts to: a scan of every message of the user's chats.
+    conditions = " AND ".join(f"m.message LIKE :term{i}" for i in range(len(terms.split())))
+    params = {f"term{i}": f"%{word}%" for i, word in enumerate(terms.split())}
+    return db.execute(text(f"""
+        SELECT m.id FROM chat_messages AS m
+        WHERE {conditions}
+          AND m.chat_id IN (SELECT id FROM chats WHERE user_id = :user_id OR friend_id = :user_id)
+        ORDER BY m.id DESC LIMIT :limit"""), dict(params, user_id=user_id, limit=limit)).all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--chats", type=int, default=20000)
+    parser.add_argument("--chats-per-user", type=int, default=20)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--trigger-messages", type=int, default=100000,
+                        help="messages inserted with the index triggers in place")
+    parser.add_argument("--users", type=int, default=20, help="users searching, per query")
+    parser.add_argument("--skip-like", action="store_true", help="do not time the LIKE scan")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words, weights = make_vocabulary(args.vocabulary, rng)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = make_engine(f"sqlite:///{os.path.join(directory, 'search.db')}", "wal")
+        Base.metadata.create_all(bind=engine)
+        user_count = max(2, args.chats * 2 // args.chats_per_user)
+        chats = [{"id": chat_id, "user_id": rng.randint(1, user_count), "friend_id": rng.randint(1, user_count)}
+                 for chat_id in range(1, args.chats + 1)]
+        with engine.begin() as conn:
+            conn.execute(insert(models.Chat), chats)
+
+        elapsed = insert_messages(engine, generate(args.messages, chats, words, weights, rng))
+        print(json.dumps({"step": "load", "messages": args.messages,
+                          "messages_per_sec": round(args.messages / elapsed)}))
+
+        start = time.perf_counter()
+        fts.create(engine)
+        print(json.dumps({"step": "reindex", "messages": args.messages,
+                          "seconds": round(time.perf_counter() - start, 2)}))
+
+        elapsed = insert_messages(engine, generate(args.trigger_messages, chats, words, weights, rng,
+                                                   start_id=args.messages + 1))
+        print(json.dumps({"step": "insert_with_index", "messages": args.trigger_messages,
+                          "messages_per_sec": round(args.trigger_messages / elapsed)}))
+
+        start = time.perf_counter()
+        fts.optimize(engine)
+        print(json.dumps({"step": "optimize", "seconds": round(time.perf_counter() - start, 2)}))
+
+        users = [rng.randint(1, user_count) for _ in range(args.users)]
+        queries = {
+            "common": [words[0], words[1], f"{words[0]} {words[1]}"],
+            "medium": [words[100], words[500], f"{words[100]} {words[0]}"],
+            "rare": [words[-1], words[-100], words[-1000]],
+            "prefix": [words[10][:3] + "*", words[200][:4] + "*", f"{words[0]} {words[50][:3]}*"],
+        }
+        for kind, terms in queries.items():
+            for order in fts.ORDERS:
+                result = time_queries(engine, terms, users,
+                                      lambda db, user_id, q: fts.search(db, user_id=user_id, terms=q, order=order))
+                print(json.dumps(dict(result, step="search", method="fts", order=order, terms=kind)))
+            if not args.skip_like and kind != "prefix":
+                result = time_queries(engine, terms, users[:3], like_search)
+                print(json.dumps(dict(result, step="search", method="like", terms=kind)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Logins per second at different bcrypt cost factors, with password checks run
+on the bounded PasswordHasher pool from many concurrent async logins.
+
+    python -m benchmarks.password_hashing --costs 10 11 12 --logins 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+# Set before chat_app is imported: importing it upgrades the database it points at,
+# which would otherwise be the chat_app.db checked into the repository
+os.environ["CHAT_APP_DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+
+from chat_app.utils import HasherBusy, PasswordHasher, make_crypt_context
+
+
+async def run(cost: int, logins: int, workers: int, max_pending: int) -> dict:
+    context = make_crypt_context(cost)
+    hasher = PasswordHasher(context, workers=workers, max_pending=max_pending)
+    stored = context.hash("correct horse battery staple")
+    latencies, rejected = [], 0
+
+    async def login():
+        nonlocal rejected
+        start = time.perf_counter()
+        try:
+            await hasher.verify_and_update_async("correct horse battery staple", stored)
+        except HasherBusy:
+            rejected += 1
+            return
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "cost": cost,
+        "workers": workers,
+        "logins": len(latencies),
+        "rejected": rejected,
+        "logins_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--costs", type=int, nargs="+", default=[10, 11, 12])
+    parser.add_argument("--logins", type=int, default=200, help="concurrent logins per cost")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--max-pending", type=int, default=1000)
+    args = parser.parse_args()
+    for cost in args.costs:
+        print(json.dumps(asyncio.run(run(cost, args.logins, args.workers, args.max_pending))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Throughput of AI rewrites with and without micro-batching, against a fake
+completion backend that adds a fixed latency to every request.
+
+    python -m benchmarks.rewrite_batching --messages 2000 --latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+# Set before chat_app is imported: importing it upgrades the database it points at,
+# which would otherwise be the chat_app.db checked into the repository
+os.environ["CHAT_APP_DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+
+from chat_app.rewrite import BatchingBackend, FakeBackend, MessageRewriter
+
+
+async def run(messages: int, latency: float, concurrency: int, window: float, batch_size: int,
+              batching: bool) -> dict:
+    fake = FakeBackend(latency=latency, transform=lambda message, tone: message.upper())
+    if batching:
+        backend = BatchingBackend(fake, window=window, max_batch=batch_size, max_concurrency=concurrency)
+        rewriter = MessageRewriter(backend, timeout=60, max_concurrency=None, enabled=True)
+    else:
+        rewriter = MessageRewriter(fake, timeout=60, max_concurrency=concurrency, enabled=True)
+    latencies = []
+
+    async def send(i: int):
+        start = time.perf_counter()
+        await rewriter.rewrite(f"message {i}", "nice")
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(messages)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "batching": batching,
+        "messages": messages,
+        "backend_calls": fake.calls,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(messages / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per backend call")
+    parser.add_argument("--concurrency", type=int, default=16, help="backend requests in flight")
+    parser.add_argument("--window", type=float, default=0.005, help="batch window in seconds")
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+    for batching in (False, True):
+        result = asyncio.run(run(args.messages, args.latency, args.concurrency,
+                                 args.window, args.batch_size, batching))
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Concurrent writers on one SQLite file, with the "default" storage profile
+(SQLite's own defaults) against the tuned "wal" profile.
+
+Each writer is a separate process, like the app and the Celery worker
+containers sharing chat_app.db, and saves messages one transaction at a
+time while a reader process pages through the chat history.
+
+    python -m benchmarks.sqlite_writers --writers 4 --messages 2000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from sqlalchemy import insert, select
+from sqlalchemy.exc import OperationalError
+
+# Set before chat_app is imported: importing it upgrades the database it points at,
+# which would otherwise be the chat_app.db checked into the repository
+os.environ["CHAT_APP_DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+
+from chat_app.db import models
+from chat_app.db.base import Base, make_engine
+
+
+def write(url: str, profile: str, writer: int, messages: int, queue):
+    engine = make_engine(url, profile)
+    latencies, errors = [], 0
+    for i in range(messages):
+        start = time.perf_counter()
+        try:
+            with engine.begin() as conn:
+                conn.execute(insert(models.ChatMessage).values(
+                    chat_id=writer, sender_id=writer, message=f"message {i}", created_at="01/01/2023, 00:00:00"))
+        except OperationalError:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    queue.put({"latencies": latencies, "errors": errors})
+
+
+def read(url: str, profile: str, stop, queue):
+    engine = make_engine(url, profile)
+    reads, errors = 0, 0
+    while not stop.is_set():
+        try:
+            with engine.connect() as conn:
+                conn.execute(select(models.ChatMessage).order_by(models.ChatMessage.id.desc()).limit(50)).all()
+            reads += 1
+        except OperationalError:
+            errors += 1
+    queue.put({"reads": reads, "errors": errors})
+
+
+def run(profile: str, writers: int, messages: int) -> dict:
+    directory = tempfile.mkdtemp()
+    url = "sqlite:///" + os.path.join(directory, "bench.db")
+    Base.metadata.create_all(bind=make_engine(url, profile))
+    queue, reader_queue, stop = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Event()
+    reader = multiprocessing.Process(target=read, args=(url, profile, stop, reader_queue))
+    processes = [multiprocessing.Process(target=write, args=(url, profile, n, messages, queue))
+                 for n in range(writers)]
+    start = time.perf_counter()
+    reader.start()
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    elapsed = time.perf_counter() - start
+    stop.set()
+    reads = reader_queue.get()
+    for process in processes + [reader]:
+        process.join()
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    return {
+        "profile": profile,
+        "writers": writers,
+        "messages": writers * messages,
+        "seconds": round(elapsed, 3),
+        "writes_per_sec": round(writers * messages / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        "locked_errors": sum(result["errors"] for result in results) + reads["errors"],
+        "reads": reads["reads"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=2000, help="messages per writer")
+    args = parser.parse_args()
+    for profile in ("default", "wal"):
+        print(json.dumps(run(profile, args.writers, args.messages)))
+
+
+if __name__ == "__main__":
+    main()
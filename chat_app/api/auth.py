@@ -1,74 +1,92 @@
 from __future__ import annotations
-from fastapi import APIRouter, Depends, Request, Response
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from fastapi.responses import RedirectResponse
-from sqlalchemy.orm import Session
-from chat_app.db import crud
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from chat_app.db import async_crud
 from chat_app.db import schemas
-from chat_app.db.base import get_db
+from chat_app.db.base import get_async_db
+from chat_app.sessions import COOKIE_NAME, UserSession, current_session, sessions
 
 router = APIRouter()
 
+
+def set_session_cookie(response: Response, user_id: int, username: str):
+    response.set_cookie(key=COOKIE_NAME, value=sessions.issue(user_id, username),
+                        max_age=int(sessions.ttl), httponly=True)
+
+
 @router.get("/api/current_user")
-def get_user(request: Request) -> str:
+def get_user(session: Optional[UserSession] = Depends(current_session)) -> Optional[str]:
     """
-    Retrieve the current user from the request cookies.
+    Retrieve the current user from the session cookie.
 
     Parameters:
-    - request: The incoming request object.
+    - session: The session of the current user.
 
     Returns:
-    - str: The value of the "X-Authorization" cookie.
+    - str: The username of the current user, or None if not logged in.
     """
-    return request.cookies.get("X-Authorization")
+    return session.username if session else None
 
 @router.post("/api/register")
-def register_user(username: schemas.RegisterValidator,
-                  response: Response) -> dict:
+async def register_user(user: schemas.RegisterValidator,
+                        response: Response,
+                        db: AsyncSession = Depends(get_async_db)) -> dict:
     """
-    Register a new user.
+    Register a new user and log them in.
 
     Parameters:
-    - username: The user registration data.
+    - user: The user registration data.
     - response: The response object to set the "X-Authorization" cookie.
+    - db: The async database session dependency.
 
     Returns:
     - dict: A message indicating the successful user registration.
     """
-    response.set_cookie(key="X-Authorization",
-                        value=username.username, httponly=True)
+    # Only a brand-new account gets a session; existing users go through /api/login
+    if await async_crud.get_user_by_username(db, username=user.username) is not None:
+        raise HTTPException(status_code=400, detail="Username already registered")
+    try:
+        db_user = await async_crud.create_user(db, username=user.username, password=user.password)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Username already registered")
+    set_session_cookie(response, db_user.id, db_user.username)
     return {"message": "User registered successfully."}
 
 @router.post("/api/login")
-def login_user(user: schemas.UserLogin, response: Response,
-               db: Session = Depends(get_db)) -> dict:
+async def login_user(user: schemas.UserLogin, response: Response,
+                     db: AsyncSession = Depends(get_async_db)) -> dict:
     """
     Login a user.
 
     Parameters:
     - user: The user login data.
     - response: The response object to set the "X-Authorization" cookie.
-    - db: The database session dependency.
+    - db: The async database session dependency.
 
     Returns:
     - dict: A dictionary containing the authentication status and additional information.
     """
-    auth = crud.login(db=db, username=user.username, password=user.password)
+    auth = await async_crud.login(db=db, username=user.username, password=user.password)
     if auth["status"]:
-        response.set_cookie(key="X-Authorization",
-                            value=user.username, httponly=True)
+        set_session_cookie(response, auth["user_id"], user.username)
     return auth
 
 @router.get("/api/logout")
-def logout_user(response: Response) -> RedirectResponse:
+def logout_user(request: Request) -> RedirectResponse:
     """
-    Logout the current user.
+    Logout the current user, revoking their session.
 
     Parameters:
-    - response: The response object to delete the "X-Authorization" cookie.
+    - request: The incoming request object.
 
     Returns:
     - RedirectResponse: A redirect response to the home page.
     """
+    sessions.revoke(request.cookies.get(COOKIE_NAME))
     response = RedirectResponse('/', status_code=302)
-    response.delete_cookie(key='X-Authorization')
+    response.delete_cookie(key=COOKIE_NAME)
     return response
@@ -1,12 +1,16 @@
 from __future__ import annotations
 import sys
 sys.path.append("..")  # Adds higher directory to python modules path.
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from chat_app import config
 from chat_app.db import crud
 from chat_app.db import schemas
 from chat_app.db.base import SessionLocal
+from chat_app.db.cache import membership
+from chat_app.sessions import UserSession, require_session
 
 router = APIRouter()
 
@@ -38,25 +42,72 @@ def create_chat(chat: schemas.ChatCreate, db: Session = Depends(get_db)) -> sche
     Returns:
     - schemas.Chat: The created chat data.
     """
-    # Check if the friendship exists
-    friendship = crud.get_friendship_by_users(db, user_id=chat.user_id, friend_id=chat.friend_id)
-    if friendship is None:
+    # Users, friendship and existing chat, checked in one query
+    check = crud.get_new_chat_check(db, user_id=chat.user_id, friend_id=chat.friend_id)
+    if check.friendship_id is None:
         raise HTTPException(status_code=404, detail="Friendship not found")
 
-    db_user = crud.get_user(db, user_id=chat.user_id)
-    if db_user is None:
+    if check.user_id is None or check.friend_id is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    db_friend = crud.get_user(db, user_id=chat.friend_id)
-    if db_friend is None:
-        raise HTTPException(status_code=404, detail="User not found")
+    if check.chat_id is not None:
+        raise HTTPException(status_code=404, detail="Chat already exists")
 
-    existing_chat = crud.get_chat_for_users(db, user_id=chat.user_id, friend_id=chat.friend_id)
-    if existing_chat is not None:
+    # Create new chat; the unique index catches a concurrent request for the same pair
+    try:
+        return crud.create_chat(db=db, chat=chat)
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(status_code=404, detail="Chat already exists")
 
-    # Create new chat
-    return crud.create_chat(db=db, chat=chat)
+
+@router.get("/api/chats/overview", response_model=List[schemas.ChatOverview])
+def read_chat_overviews(db: Session = Depends(get_db),
+                        session: UserSession = Depends(require_session)) -> List[schemas.ChatOverview]:
+    """
+    List the chats of the current user with their last message and unread count.
+
+    Parameters:
+    - db: The database session dependency.
+    - session: The session of the current user.
+
+    Returns:
+    - List[schemas.ChatOverview]: The chats, most recently active first.
+    """
+    overviews = []
+    for chat, summary, state in crud.get_chat_overviews(db, user_id=session.user_id):
+        overview = {"id": chat.id, "user_id": chat.user_id, "friend_id": chat.friend_id}
+        if summary is not None:
+            overview.update(last_message_id=summary.last_message_id, last_sender_id=summary.last_sender_id,
+                            snippet=summary.snippet, last_created_at=summary.last_created_at,
+                            message_count=summary.message_count)
+        if state is not None:
+            overview.update(last_read_id=state.last_read_id, unread_count=state.unread_count)
+        overviews.append(schemas.ChatOverview(**overview))
+    return overviews
+
+
+@router.post("/api/chats/{chat_id}/read", response_model=schemas.ChatReadState)
+def mark_chat_read(chat_id: int, message_id: Optional[int] = None, db: Session = Depends(get_db),
+                   session: UserSession = Depends(require_session)) -> schemas.ChatReadState:
+    """
+    Mark the messages of a chat as read by the current user.
+
+    Parameters:
+    - chat_id: The ID of the chat.
+    - message_id: The last message read, the latest message of the chat if not given.
+    - db: The database session dependency.
+    - session: The session of the current user.
+
+    Returns:
+    - schemas.ChatReadState: The read cursor and unread count of the user in the chat.
+    """
+    participants = crud.get_chat_participants(db, chat_id=chat_id)
+    if participants is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if session.user_id not in participants:
+        raise HTTPException(status_code=403, detail="Not a member of this chat")
+    return crud.mark_chat_read(db, chat_id=chat_id, user_id=session.user_id, message_id=message_id)
 
 
 @router.get("/api/chats/{chat_id}", response_model=schemas.Chat)
@@ -78,19 +129,21 @@ def read_chat(chat_id: int, db: Session = Depends(get_db)) -> schemas.Chat:
 
 
 @router.get("/api/chats/", response_model=List[schemas.Chat])
-def read_chats(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)) -> List[schemas.Chat]:
+def read_chats(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=config.MAX_PAGE_SIZE),
+               after_id: Optional[int] = None, db: Session = Depends(get_db)) -> List[schemas.Chat]:
     """
     Read all chats.
 
     Parameters:
     - skip: Number of chats to skip (for pagination).
     - limit: Maximum number of chats to retrieve (for pagination).
+    - after_id: Only return chats after this chat ID (keyset pagination, takes precedence over skip).
     - db: The database session dependency.
 
     Returns:
     - List[schemas.Chat]: A list of chat data.
     """
-    chats = crud.get_chats_all(db)
+    chats = crud.get_chats_all(db, skip=skip, limit=limit, after_id=after_id)
     return chats
 
 
@@ -128,8 +181,7 @@ def read_chat_history(user_id: int, friend_id: int, db: Session = Depends(get_db
     - List[schemas.Chat]: A list of chat data.
     """
     # Check if the friendship exists
-    friendship = crud.get_friendship_by_users(db, user_id=user_id, friend_id=friend_id)
-    if friendship is None:
+    if not membership.are_friends(user_id, friend_id):
         raise HTTPException(status_code=404, detail="Friendship not found")
     # Retrieve all chats between the two users
     return crud.get_chats_by_users(db, user_id=user_id, friend_id=friend_id)
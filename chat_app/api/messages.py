@@ -1,31 +1,159 @@
 from __future__ import annotations
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException
+import json
+import zlib
+from datetime import date, datetime, time
+from typing import Iterator, List, Optional, Union
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
+from chat_app import config
 from chat_app.db import crud
 from chat_app.db import schemas
-from chat_app.db.base import get_db
+from chat_app.db import fts
+from chat_app.db.cache import membership, usernames
+from chat_app.db.base import SessionLocal, get_db
+from chat_app.sessions import UserSession, require_session
 router = APIRouter()
 
 
-@router.get("/api/chats/{chat_id}/messages", response_model=List[schemas.ChatMessage])
-def read_chat(chat_id: int, db: Session = Depends(get_db)) -> List[schemas.ChatMessage]:
+def start_of(value: Union[datetime, date, None]) -> Optional[datetime]:
     """
-    Read all messages for a chat.
+    Turn a day into the datetime it starts at; datetimes are returned as they are.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.combine(value, time.min)
+
+
+@router.get("/api/messages/search", response_model=List[schemas.MessageSearchResult])
+def search_messages(q: str = Query(..., min_length=1, max_length=256), chat_id: Optional[int] = None,
+                    order: str = Query("relevance", regex="^(relevance|recent)$"),
+                    skip: int = Query(0, ge=0), limit: int = Query(20, ge=1, le=config.MAX_PAGE_SIZE),
+                    db: Session = Depends(get_db),
+                    session: UserSession = Depends(require_session)) -> List[schemas.MessageSearchResult]:
+    """
+    Search the messages of the current user's chats.
+
+    Parameters:
+    - q: The words to look for; a word ending with "*" matches as a prefix.
+    - chat_id: Only search this chat, if given.
+    - order: "relevance" for the best matches first, or "recent" for the newest first.
+    - skip: Number of results to skip (for pagination).
+    - limit: Maximum number of results to retrieve.
+    - db: The database session dependency.
+    - session: The session of the current user.
+
+    Returns:
+    - List[schemas.MessageSearchResult]: The matching messages, best first, with a highlighted snippet.
+    """
+    try:
+        return fts.search(db, user_id=session.user_id, terms=q, chat_id=chat_id, order=order,
+                          limit=limit, offset=skip)
+    except fts.SearchUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@router.get("/api/chats/{chat_id}/messages", response_model=List[schemas.ChatMessageRead])
+def read_chat(chat_id: int, before_id: Optional[int] = None, after_id: Optional[int] = None,
+              since: Union[datetime, date, None] = None, until: Union[datetime, date, None] = None,
+              limit: int = Query(100, ge=1, le=config.MAX_PAGE_SIZE),
+              db: Session = Depends(get_db)) -> List[schemas.ChatMessageRead]:
+    """
+    Read a page of messages for a chat, in ascending order.
+
+    Without cursors the latest messages are returned. Pass the id of the
+    oldest message received as before_id to page backwards, or the id of the
+    newest one as after_id to fetch what was sent since. since and until
+    restrict the page to the messages sent in that time range.
 
     Parameters:
     - chat_id: The ID of the chat.
+    - before_id: Only return messages older than this message ID.
+    - after_id: Only return messages newer than this message ID.
+    - since: Only return messages sent at or after this time, or day.
+    - until: Only return messages sent before this time, or day.
+    - limit: Maximum number of messages to retrieve.
     - db: The database session dependency.
 
     Returns:
-    - List[schemas.ChatMessage]: A list of chat message data.
+    - List[schemas.ChatMessageRead]: A list of chat message data.
     """
-    chat_messages = crud.get_chat_messages(db, chat_id=chat_id)
+    chat_messages = crud.get_chat_messages(db, chat_id=chat_id, before_id=before_id,
+                                           after_id=after_id, limit=limit,
+                                           since=start_of(since), until=start_of(until))
     if chat_messages is None:
         raise HTTPException(status_code=404, detail="Chat not found")
     return chat_messages
 
 
+def export_chunks(chat_id: int, compress: bool = False) -> Iterator[bytes]:
+    """
+    Serialize the messages of a chat as NDJSON, one line per message.
+
+    The rows are read EXPORT_BATCH_SIZE at a time and each batch is yielded
+    as one chunk, so memory stays flat whatever the length of the chat. The
+    generator opens its own database session, as it outlives the request's.
+
+    Parameters:
+    - chat_id: The ID of the chat.
+    - compress: Gzip the output.
+    """
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+    db = SessionLocal()
+    try:
+        lines = []
+        rows = crud.iter_chat_messages(db, chat_id=chat_id, batch_size=config.EXPORT_BATCH_SIZE)
+        for message_id, sender_id, message_chat_id, message, created_at, sent_at in rows:
+            lines.append(encode({"id": message_id, "sender_id": sender_id, "chat_id": message_chat_id,
+                                 "message": message, "created_at": created_at,
+                                 "sent_at": sent_at.isoformat() if sent_at else None}))
+            if len(lines) == config.EXPORT_BATCH_SIZE:
+                chunk = ("\n".join(lines) + "\n").encode()
+                lines = []
+                chunk = compressor.compress(chunk) if compressor else chunk
+                if chunk:
+                    yield chunk
+        chunk = ("\n".join(lines) + "\n").encode() if lines else b""
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
+    finally:
+        db.close()
+
+
+@router.get("/api/chats/{chat_id}/messages/export")
+def export_chat(chat_id: int, compression: Optional[str] = Query(None, regex="^gzip$"),
+                db: Session = Depends(get_db),
+                session: UserSession = Depends(require_session)) -> StreamingResponse:
+    """
+    Download the whole history of a chat as NDJSON, streamed as it is read.
+
+    Parameters:
+    - chat_id: The ID of the chat.
+    - compression: "gzip" for a gzipped file.
+    - db: The database session dependency.
+    - session: The session of the current user.
+
+    Returns:
+    - StreamingResponse: One JSON message per line, oldest first.
+    """
+    participants = crud.get_chat_participants(db, chat_id=chat_id)
+    if participants is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if session.user_id not in participants:
+        raise HTTPException(status_code=403, detail="Not a member of this chat")
+    filename = f"chat-{chat_id}.ndjson"
+    media_type = "application/x-ndjson"
+    if compression == "gzip":
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(export_chunks(chat_id, compress=compression == "gzip"), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
 @router.post("/api/chats/{chat_id}/messages", response_model=schemas.ResponseMessage)
 def create_message(chat_id: int, message: schemas.MessageCreate, db: Session = Depends(get_db)) -> schemas.ResponseMessage:
     """
@@ -39,28 +167,19 @@ def create_message(chat_id: int, message: schemas.MessageCreate, db: Session = D
     Returns:
     - schemas.ResponseMessage: The response message.
     """
-    try:
-        # Check if the chat exists
-        chat = crud.get_chat(db, chat_id)
-        if chat is None:
-            raise HTTPException(status_code=404, detail="Chat does not exist")
-
-        # Check if the friendship exists
-        friendship = crud.get_friendship_by_users(db, user_id=chat.user_id, friend_id=chat.friend_id)
-        if friendship is None:
-            raise HTTPException(status_code=404, detail="Friendship not found")
-
-        db_user = crud.get_user(db, user_id=chat.user_id)
-        if db_user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        db_friend = crud.get_user(db, user_id=chat.friend_id)
-        if db_friend is None:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Create new message
-        return crud.create_message(db=db, message=message, chat_id=chat_id)
-    except Exception as e:
-        print(str(e))
-
-    return None
+    # Chat, friendship and participants, all checked against the caches
+    participants = crud.get_chat_participants(db, chat_id=chat_id)
+    if participants is None:
+        raise HTTPException(status_code=404, detail="Chat does not exist")
+
+    if not membership.are_friends(*participants):
+        raise HTTPException(status_code=404, detail="Friendship not found")
+
+    if len(usernames.get_many(db, participants)) < len(set(participants)):
+        raise HTTPException(status_code=404, detail="User not found")
+
+    if message.sender_id not in participants:
+        raise HTTPException(status_code=403, detail="Sender is not a member of this chat")
+
+    # Create new message, in the chat of the path
+    return crud.create_message(dict(message.dict(), chat_id=chat_id))
@@ -0,0 +1,17 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from chat_app import metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+def get_metrics() -> Response:
+    """
+    Prometheus scrape endpoint.
+
+    Returns:
+    - Response: The metrics in the Prometheus text format.
+    """
+    # As a header, since media_type would get a second charset appended
+    return Response(content=metrics.render(), headers={"Content-Type": CONTENT_TYPE_LATEST})
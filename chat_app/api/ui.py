@@ -5,8 +5,12 @@ router = APIRouter()
 from fastapi import Depends, HTTPException, Request, FastAPI
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
+from chat_app import config
 from chat_app.db import crud
 from chat_app.db.base import get_db
+from chat_app.db.cache import usernames
+from chat_app.sessions import UserSession, current_session
+from typing import Optional
 from datetime import datetime
 import os
 script_dir = os.path.dirname(__file__)
@@ -17,37 +21,36 @@ templates = Jinja2Templates(directory=templates_abs_file_path)
 
 app = FastAPI()
 
-@router.get("/")
-def get_home(request: Request, db: Session = Depends(get_db)) -> templates.TemplateResponse:
+@router.get("/", response_model=None)
+def get_home(request: Request, db: Session = Depends(get_db),
+             session: Optional[UserSession] = Depends(current_session)) -> templates.TemplateResponse:
     """
     Get the home page.
 
     Parameters:
     - request: The incoming request object.
     - db: The database session dependency.
+    - session: The session of the current user.
 
     Returns:
     - templates.TemplateResponse: The rendered template response for the home page.
     """
-    current_user = request.cookies.get("X-Authorization")
+    current_user = session.username if session else None
     chats = []
     users = []
-    if current_user:
-        db_user = crud.get_user_by_username(db, username=current_user)
-        if not db_user:
-            raise HTTPException(status_code=404, detail="User not found")
-        chats = crud.get_chats_by_users(db, user_id=db_user.id)
-        users = {}
-        for chat in chats:
-            users[chat.user_id] = crud.get_username_by_id(db, chat.user_id)
-            users[chat.friend_id] = crud.get_username_by_id(db, chat.friend_id)
+    if session:
+        # Chats with their last message and unread count, in one query
+        chats = crud.get_chat_overviews(db, user_id=session.user_id)
+        # One query for the names of every participant, none if they are cached
+        users = usernames.get_many(db, {chat.user_id for chat, _, _ in chats} | {chat.friend_id for chat, _, _ in chats})
     return templates.TemplateResponse("home.html", {"current_user" : current_user, "request": request, "chats": chats,
                                                     "users": users})
 
 
-@router.get("/{chat_id}")
+@router.get("/{chat_id}", response_model=None)
 def get_chat_page(chat_id: int, request: Request,
-                  db: Session = Depends(get_db)) -> templates.TemplateResponse:
+                  db: Session = Depends(get_db),
+                  session: Optional[UserSession] = Depends(current_session)) -> templates.TemplateResponse:
     """
     Get the chat page for a specific chat ID.
 
@@ -55,6 +58,7 @@ def get_chat_page(chat_id: int, request: Request,
     - chat_id: The ID of the chat.
     - request: The incoming request object.
     - db: The database session dependency.
+    - session: The session of the current user.
 
     Returns:
     - templates.TemplateResponse: The rendered template response for the chat page.
@@ -62,23 +66,33 @@ def get_chat_page(chat_id: int, request: Request,
     db_chat = crud.get_chat(db, chat_id=chat_id)
     if db_chat is None:
         raise HTTPException(status_code=404, detail="Chat page not found")
-    db_user = crud.get_user(db, user_id=db_chat.user_id)
-    db_friend = crud.get_user(db, user_id=db_chat.friend_id)
+    participants = {user.id: user for user in crud.get_users_by_ids(db, [db_chat.user_id, db_chat.friend_id])}
+    db_user = participants.get(db_chat.user_id)
+    db_friend = participants.get(db_chat.friend_id)
     if not db_user:
         raise HTTPException(status_code=404, detail="User #1 not found")
     if not db_friend:
         raise HTTPException(status_code=404, detail="User #2 not found")
 
-    current_user = request.cookies.get("X-Authorization")
-    if current_user != db_user.username and current_user != db_friend.username:
+    if session is None or session.user_id not in (db_user.id, db_friend.id):
         raise HTTPException(status_code=401, detail="Not authorized to view this chat")
 
-    friend_id = db_friend.id if current_user != db_friend.username else db_user.id
-    user_id = db_friend.id if current_user == db_friend.username else db_user.id
+    current_user = session.username
+    user_id = session.user_id
+    friend_id = db_friend.id if user_id == db_user.id else db_user.id
     users = {db_user.id : db_user, db_friend.id: db_friend}
-    db_chat_messages = crud.get_chat_messages(db, chat_id)
+    # Only the latest window is rendered, older pages are fetched by the page on demand
+    db_chat_messages = crud.get_chat_messages(db, chat_id, limit=config.CHAT_PAGE_SIZE)
+    if db_chat_messages:
+        # Marking the chat read commits, which would expire every row loaded
+        # above and have the template reload them one query at a time
+        db.expunge_all()
+        crud.mark_chat_read(db, chat_id=chat_id, user_id=user_id, message_id=db_chat_messages[-1].id)
     return templates.TemplateResponse("chat.html", {"datetime": datetime, "chat": db_chat,
                                                     "messages": db_chat_messages,
+                                                    "has_more": len(db_chat_messages) == config.CHAT_PAGE_SIZE,
+                                                    "page_size": config.CHAT_PAGE_SIZE,
+                                                    "usernames": {id: user.username for id, user in users.items()},
                                                     "users" : users, "request" : request,
                                                     "user_id" : user_id,
                                                     "current_user": current_user,
@@ -1,15 +1,18 @@
 import sys
 sys.path.append("../..") # Adds higher directory to python modules path.
 from fastapi import APIRouter
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from chat_app.db import crud, models
+from chat_app import config
+from chat_app.db import async_crud, crud, models
 from chat_app.db import schemas
-from chat_app.db.base import get_db
+from chat_app.db.base import get_async_db, get_db
+from chat_app.db.cache import membership
 from chat_app.utils import hash_password
 
 router = APIRouter()
@@ -53,19 +56,21 @@ def read_user(user_id: int, db: Session = Depends(get_db)) -> schemas.User:
 
 
 @router.get("/api/users", response_model=List[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)) -> List[schemas.User]:
+def read_users(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=config.MAX_PAGE_SIZE),
+               after_id: Optional[int] = None, db: Session = Depends(get_db)) -> List[schemas.User]:
     """
     Read all users.
 
     Parameters:
     - skip: The number of users to skip.
     - limit: The maximum number of users to retrieve.
+    - after_id: Only return users after this user ID (keyset pagination, takes precedence over skip).
     - db: The database session dependency.
 
     Returns:
     - List[schemas.User]: A list of user data.
     """
-    users = crud.get_users(db)
+    users = crud.get_users(db, skip=skip, limit=limit, after_id=after_id)
     return users
 
 
@@ -97,36 +102,40 @@ def update_user(user_id: int, user: schemas.UserUpdate,
 
 
 @router.post("/api/users/{user_id}/friends", response_model=schemas.Friend)
-async def create_friend(user_id: int, user: schemas.UserID, db: Session = Depends(get_db)) -> schemas.Friend:
+async def create_friend(user_id: int, user: schemas.UserID,
+                        db: AsyncSession = Depends(get_async_db)) -> schemas.Friend:
     """
     Create a friendship between two users.
 
     Parameters:
     - user_id: The ID of the user.
     - user: The friend data.
-    - db: The database session dependency.
+    - db: The async database session dependency.
 
     Returns:
     - schemas.Friend: The created friendship data.
     """
     friend_id = user.id
-    db_user = crud.get_user(db, user_id=user_id)
+    db_user = await async_crud.get_user(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    db_friend = crud.get_user(db, user_id=friend_id)
+    db_friend = await async_crud.get_user(db, user_id=friend_id)
     if db_friend is None:
         raise HTTPException(status_code=404, detail="Friend not found")
 
-    db_friendship = crud.get_friendship_by_users(db=db, user_id=user_id, friend_id=friend_id)
-    if db_friendship is not None:
+    await membership.load()
+    if membership.are_friends(user_id, friend_id):
         raise HTTPException(status_code=404, detail="Users are already friends")
 
-    return crud.create_friendship(db=db, user_id=user_id, friend_id=friend_id)
+    return await async_crud.create_friendship(db=db, user_id=user_id, friend_id=friend_id)
 
 
 @router.get("/api/users/{user_id}/friends", response_model=List[schemas.Friend])
-def read_friends_for_user(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)) -> List[schemas.Friend]:
+def read_friends_for_user(user_id: int, skip: int = Query(0, ge=0),
+                          limit: int = Query(100, ge=1, le=config.MAX_PAGE_SIZE),
+                          after_id: Optional[int] = None,
+                          db: Session = Depends(get_db)) -> List[schemas.Friend]:
     """
     Read all friends for a user.
 
@@ -134,13 +143,13 @@ def read_friends_for_user(user_id: int, skip: int = 0, limit: int = 100, db: Ses
     - user_id: The ID of the user.
     - skip: The number of friends to skip.
     - limit: The maximum number of friends to retrieve.
+    - after_id: Only return friendships after this friendship ID (keyset pagination, takes precedence over skip).
     - db: The database session dependency.
 
     Returns:
     - List[schemas.Friend]: A list of friend data.
     """
-def read_friends_for_user(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    friends = crud.get_friends(db, user_id=user_id)
+    friends = crud.get_friends(db, user_id=user_id, skip=skip, limit=limit, after_id=after_id)
     return friends
 
 
@@ -165,7 +174,7 @@ def delete_friend(user_id: int, friend_id: int, db: Session = Depends(get_db)) -
     if db_friend is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    db_friendship = crud.get_friendship_by_user_ids(db, user_id=user_id, friend_id=friend_id)
+    db_friendship = crud.get_friendship_by_users(db, user_id=user_id, friend_id=friend_id)
     if db_friendship is None:
         raise HTTPException(status_code=404, detail="Users are not friends")
     return crud.delete_friendship(db=db, friendship_id=db_friendship.id)
@@ -190,4 +199,4 @@ def delete_user(user_id: int, db: Session = Depends(get_db)) -> schemas.Response
     db_is_friend = crud.check_is_friend(db, user_id=user_id)
     if db_is_friend is not None:
         raise HTTPException(status_code=404, detail="User is a friend, can not be deleted")
-    return crud.delete_user(db=db, db_user=db_user)
+    return crud.delete_user(db=db, user_id=user_id)
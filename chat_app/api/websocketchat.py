@@ -1,55 +1,269 @@
 from chat_app.db.base import Base, engine
 from chat_app.ws import manager
-from sqlalchemy.orm import Session
-from chat_app.db import crud
-from chat_app.db.base import get_db
+from chat_app.db import async_crud
+from chat_app.db.base import AsyncSessionLocal
 import datetime
+import json
+from typing import Dict, List, Optional, Union
 Base.metadata.create_all(bind=engine)
 from chat_app.main import app
-from chat_app.tasks import send_message
-from fastapi import WebSocket, WebSocketDisconnect, Depends
-from chat_app.utils import ai_rewrite_message
-from chat_app.config import tone
+from chat_app.persistence import writer
+from fastapi import WebSocket, WebSocketDisconnect
+from chat_app.rewrite import rewriter
+from chat_app.config import SYNC_CHUNK_SIZE, SYNC_MAX_MESSAGES, TIMESTAMP_FORMAT, tone
+from chat_app.sessions import sessions
+
+
+async def can_join_chat(user_id: int, chat_id) -> bool:
+    """
+    Check whether a user is one of the two participants of a chat.
+
+    Parameters:
+    - user_id: The ID of the user.
+    - chat_id: The ID of the chat.
+
+    Returns:
+    - bool: True if the user may subscribe to the chat.
+    """
+    chat_id = parse_chat_id(chat_id)
+    if chat_id is None:
+        return False
+    # The session only takes a pooled connection when the chat is not cached
+    async with AsyncSessionLocal() as db:
+        participants = await async_crud.get_chat_participants(db, chat_id=chat_id)
+    return participants is not None and user_id in participants
+
+
+def parse_chat_id(value) -> Optional[int]:
+    """
+    Parse a chat ID sent by a client, or return None if it is not a number.
+    """
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_frame(text: Union[str, bytes, None]) -> Optional[dict]:
+    """
+    Parse a frame sent by a client, or return None if it is not a JSON object.
+    """
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def parse_last_seen(values) -> Dict[int, Union[int, datetime.datetime]]:
+    """
+    Parse ``last_seen`` query parameters of the form "<chat_id>:<cursor>".
+
+    The cursor is the ISO sent_at of the newest message the client shows,
+    live ones included, or the ID of the newest saved message it has.
+
+    Returns:
+    - dict: The cursor of each chat, by chat ID. Malformed values are ignored.
+    """
+    last_seen = {}
+    for value in values:
+        chat_id, _, cursor = value.partition(":")
+        chat_id = parse_chat_id(chat_id)
+        if chat_id is None:
+            continue
+        try:
+            last_seen[chat_id] = int(cursor)
+        except ValueError:
+            try:
+                last_seen[chat_id] = datetime.datetime.fromisoformat(cursor)
+            except ValueError:
+                continue
+    return last_seen
+
+
+async def send_missed_messages(websocket: WebSocket, chat_id: int,
+                               last_seen: Union[int, datetime.datetime]):
+    """
+    Send a reconnecting client the messages of a chat it has not seen, in chunks.
+
+    Live messages reach clients before they are saved, so they carry no ID;
+    a sent_at cursor covers them too. The messages sent at the cursor itself
+    are sent again, for the client to match with the ones it shows.
+
+    Each chunk is a ``{"type": "sync", ...}`` event holding up to
+    SYNC_CHUNK_SIZE messages in sent_at (or, for an ID cursor, id) order;
+    the last one has ``"done": true``.
+    Past SYNC_MAX_MESSAGES, the last chunk also has ``"truncated": true`` and
+    the client should reload the chat instead. Each chunk is read in a session
+    of its own, closed before the chunk is sent.
+
+    Messages still buffered by other workers, or queued for Celery, are not
+    in the database yet. The live events of the chat this worker received in
+    the last SYNC_REPLAY_SECONDS are sent again after the last chunk to cover
+    them; the client drops the ones it already shows. A message left unsaved
+    for longer than that, or sent before this worker started, can still be
+    missed until the page is reloaded.
+
+    Parameters:
+    - websocket: The WebSocket connection, whose live events are paused.
+    - chat_id: The ID of the chat.
+    - last_seen: The sent_at of the newest message the client shows, or the ID of its newest saved one.
+    """
+    sent = 0
+    if isinstance(last_seen, datetime.datetime):
+        sent_at, after_id = last_seen, 0
+    else:
+        sent_at, after_id = None, last_seen
+    while True:
+        async with AsyncSessionLocal() as db:
+            if sent_at is not None:
+                messages = await async_crud.get_chat_messages_sent_after(db, chat_id=chat_id, sent_at=sent_at,
+                                                                         after_id=after_id, limit=SYNC_CHUNK_SIZE)
+            else:
+                messages = await async_crud.get_chat_messages(db, chat_id=chat_id, after_id=after_id,
+                                                              limit=SYNC_CHUNK_SIZE)
+            names = await async_crud.get_usernames(db, {message.sender_id for message in messages})
+        sent += len(messages)
+        done = len(messages) < SYNC_CHUNK_SIZE
+        truncated = not done and sent >= SYNC_MAX_MESSAGES
+        await websocket.send_json({
+            "type": "sync",
+            "chat_id": chat_id,
+            "messages": [{"id": message.id,
+                          "sender_id": message.sender_id,
+                          "sender": names.get(message.sender_id),
+                          "message": message.message,
+                          "chat_id": message.chat_id,
+                          "created_at": message.created_at,
+                          "sent_at": message.sent_at.isoformat() if message.sent_at else None}
+                         for message in messages],
+            "done": done or truncated,
+            "truncated": truncated,
+        })
+        if truncated:
+            return
+        if done:
+            break
+        after_id = messages[-1].id
+        if sent_at is not None:
+            sent_at = messages[-1].sent_at
+    for payload in manager.recent_messages(chat_id, since=last_seen):
+        await websocket.send_text(payload)
+
+
+async def report_unsaved(messages: List[dict]):
+    """
+    Tell the senders of messages that could not be saved, on every connection they have open.
+
+    The failure names the chat and sent_at of the message, for the client to
+    match it with the one it shows.
+
+    Parameters:
+    - messages: The messages given up on by the writer.
+    """
+    async with AsyncSessionLocal() as db:
+        names = await async_crud.get_usernames(db, {message['sender_id'] for message in messages})
+    for message in messages:
+        name = names.get(message['sender_id'])
+        if name is None:
+            continue
+        await manager.send_to_user(name, {
+            "chat_id": message['chat_id'],
+            "sent_at": message['sent_at'],
+            "message": message['message'],
+            "db_status": {"success": False, "message": "Message could not be saved: " + message['message']},
+        })
+
+
+writer.on_failure = report_unsaved
+
 
 @app.websocket("/ws/chat")
-async def chat(websocket: WebSocket, db: Session = Depends(get_db)):
+async def chat(websocket: WebSocket):
     """
     WebSocket endpoint for handling chat communication.
 
+    The chats to listen to are passed as repeated ``chat_id`` query parameters,
+    or later on with a ``{"action": "subscribe", "chat_id": ...}`` message.
+    Messages are only delivered to the members of the chat they belong to.
+    Members joining and leaving are announced with coalesced "presence" events.
+
+    A reconnecting client passes the sent_at of the newest message it shows
+    of a chat as ``last_seen=<chat_id>:<sent_at>``. It first gets the messages it
+    missed (see send_missed_messages), then the live events of its chats,
+    which were held back in the meantime.
+
+    The socket holds no database session: each lookup opens a short one, so
+    idle connections do not keep pooled database connections checked out.
+
     Parameters:
     - websocket: The WebSocket connection object.
-    - db: The database session dependency.
-    """
-
-    sender = websocket.cookies.get("X-Authorization")
-    if sender:
-        await manager.connect(websocket, sender)
-        response = {
-            "sender": sender,
-            "message": "got connected",
-            "created_at": datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-        }
-        await manager.broadcast(response)
+    """
+
+    session = sessions.from_connection(websocket)
+    if session:
+        sender = session.username
+        chat_ids = {int(chat_id) for chat_id in websocket.query_params.getlist("chat_id")
+                    if await can_join_chat(session.user_id, chat_id)}
+        last_seen = {chat_id: cursor for chat_id, cursor in
+                     parse_last_seen(websocket.query_params.getlist("last_seen")).items() if chat_id in chat_ids}
+        if not await manager.connect(websocket, sender, chat_ids, paused=bool(last_seen)):
+            return
         try:
+            if last_seen:
+                # Save what this worker still buffers; what other workers buffer is replayed
+                await writer.flush()
+                for chat_id, cursor in last_seen.items():
+                    await send_missed_messages(websocket, chat_id, cursor)
+                manager.resume(websocket)
             while True:
-                data = await websocket.receive_json()
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", 1000))
+                data = parse_frame(frame.get("text") or frame.get("bytes"))
+                if data is None:
+                    manager.send(websocket, {"type": "error", "detail": "invalid_frame"})
+                    continue
+                if data.get("action") == "subscribe":
+                    chat_id = parse_chat_id(data.get("chat_id"))
+                    if chat_id is not None and await can_join_chat(session.user_id, chat_id):
+                        manager.subscribe(websocket, chat_id)
+                    continue
                 if all(key in data for key in ('chat_id', 'sender_id',"message")):
-                    creation_timestamp = datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                    rewritten_message =  ai_rewrite_message(data['message'], tone)
-                    message = {'sender_id': data['sender_id'],
+                    chat_id = parse_chat_id(data['chat_id'])
+                    if chat_id is None or not isinstance(data['message'], str) or not data['message']:
+                        manager.send(websocket, {"type": "error", "detail": "invalid_message"})
+                        continue
+                    if not manager.is_subscribed(websocket, chat_id):
+                        if not await can_join_chat(session.user_id, chat_id):
+                            continue
+                        manager.subscribe(websocket, chat_id)
+                    sent_at = datetime.datetime.now()
+                    creation_timestamp = sent_at.strftime(TIMESTAMP_FORMAT)
+                    rewritten_message = await rewriter.rewrite(data['message'], tone)
+                    # The sender is whoever the session belongs to, not what the client claims
+                    message = {'sender_id': session.user_id,
                                'message': rewritten_message,
-                               'chat_id': data['chat_id'],
-                               'created_at': creation_timestamp}
+                               'chat_id': chat_id,
+                               'created_at': creation_timestamp,
+                               'sent_at': sent_at.isoformat()}
 
-                    send_message.delay(message=message)
+                    await writer.submit(message)
                     data = {
-                        'sender': crud.get_username_by_id(db=db, user_id=data['sender_id']).username,
+                        'sender': sender,
                         "message": rewritten_message,
+                        "chat_id": chat_id,
                         "created_at": creation_timestamp,
+                        "sent_at": sent_at.isoformat(),
                         "db_status" : {"status": True, "message": "Message sent successfully"}
                     }
-                await manager.broadcast(data)
+                    await manager.broadcast(data, chat_id)
         except WebSocketDisconnect:
+            pass
+        finally:
+            # Whatever ended the loop, the connection must not keep counting against the user
             manager.disconnect(websocket, sender)
-            response['message'] = "left"
-            await manager.broadcast(response)
+    else:
+        await websocket.close(code=1008)
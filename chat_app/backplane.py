@@ -0,0 +1,153 @@
+"""
+Backplanes carrying outbound websocket events between app worker processes.
+
+The socket manager publishes every event once on the backplane, and every
+worker delivers the events it receives to its own local subscribers. An
+event goes to a channel, "chat:<id>" or "user:<name>", or "membership" for
+changes to the membership caches; events published on a channel are
+delivered in the order they were published.
+"""
+import asyncio
+import logging
+import queue
+import socket
+import threading
+import uuid
+from typing import Callable, Optional
+from chat_app import config
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, str], None]
+
+
+class Backplane:
+    """
+    Publish/subscribe transport for serialized websocket events.
+    """
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver):
+        """
+        Start receiving events.
+
+        Parameters:
+        - deliver: Called on the event loop with (channel, payload) for every event.
+        """
+        self.deliver = deliver
+
+    def publish(self, channel: str, payload: str):
+        """
+        Publish an event to every worker, this one included.
+
+        Parameters:
+        - channel: The channel of the event, e.g. "chat:1".
+        - payload: The serialized JSON payload.
+        """
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class InMemoryBackplane(Backplane):
+    """
+    Backplane of a single process: events are delivered straight away.
+    """
+
+    def publish(self, channel: str, payload: str):
+        if self.deliver is not None:
+            self.deliver(channel, payload)
+
+
+class AmqpBackplane(Backplane):
+    """
+    Backplane over the AMQP broker used by Celery.
+
+    Events are published to a fanout exchange, which copies them to one
+    exclusive queue per worker. Publishing and consuming happen on two
+    background threads, so the event loop never waits on the broker; each
+    is a single FIFO, which keeps the events of a channel in order.
+    """
+
+    def __init__(self, url: str = config.BROKER_URL, exchange: str = config.BACKPLANE_EXCHANGE):
+        super().__init__()
+        from kombu import Exchange
+        self.url = url
+        self.exchange = Exchange(exchange, type="fanout", durable=False)
+        self.queue_name = f"{exchange}.{uuid.uuid4().hex}"
+        self._outbox: "queue.Queue[Optional[dict]]" = queue.Queue()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        self._loop = asyncio.get_running_loop()
+        self._stopping.clear()
+        self._threads = [threading.Thread(target=self._publish_forever, name="backplane-publisher", daemon=True),
+                         threading.Thread(target=self._consume_forever, name="backplane-consumer", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def publish(self, channel: str, payload: str):
+        self._outbox.put({"channel": channel, "payload": payload})
+
+    async def stop(self):
+        self._stopping.set()
+        self._outbox.put(None)
+        for thread in self._threads:
+            await asyncio.to_thread(thread.join, 5)
+        self._threads = []
+
+    def _publish_forever(self):
+        from kombu import Connection
+        event = None
+        while not self._stopping.is_set():
+            try:
+                with Connection(self.url) as connection:
+                    producer = connection.Producer(serializer="json")
+                    while True:
+                        if event is None:
+                            event = self._outbox.get()
+                        if event is None:
+                            return
+                        producer.publish(event, exchange=self.exchange, routing_key="",
+                                         declare=[self.exchange], retry=True)
+                        event = None
+            except Exception:
+                # Keep the unsent event so that it goes out first once reconnected
+                logger.exception("Backplane publisher lost its broker connection, reconnecting")
+                self._stopping.wait(1)
+
+    def _consume_forever(self):
+        from kombu import Connection, Queue
+        events = Queue(self.queue_name, exchange=self.exchange, exclusive=True, auto_delete=True, durable=False)
+        while not self._stopping.is_set():
+            try:
+                with Connection(self.url) as connection:
+                    with connection.Consumer(events, callbacks=[self._on_message], accept=["json"]):
+                        while not self._stopping.is_set():
+                            try:
+                                connection.drain_events(timeout=1)
+                            except socket.timeout:
+                                pass
+            except Exception:
+                logger.exception("Backplane consumer lost its broker connection, reconnecting")
+                self._stopping.wait(1)
+
+    def _on_message(self, body: dict, message):
+        message.ack()
+        self._loop.call_soon_threadsafe(self.deliver, body["channel"], body["payload"])
+
+
+def make_backplane(name: str = config.BACKPLANE) -> Backplane:
+    """
+    Build the backplane configured by name ("memory" or "amqp").
+    """
+    backplanes = {"memory": InMemoryBackplane, "amqp": AmqpBackplane}
+    if name not in backplanes:
+        raise ValueError(f"Unknown backplane: {name}")
+    return backplanes[name]()
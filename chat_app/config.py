@@ -5,8 +5,42 @@ BASE_URL = "http://localhost:8000"
 # Get the path to the current directory
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Set the relative path to the database file
-SQLALCHEMY_DATABASE_URL = "sqlite:////" + os.path.join(base_dir, "chat_app.db")
+# Set the relative path to the database file; CHAT_APP_DATABASE_URL points the
+# app at another database, e.g. the throwaway one of the load test.
+SQLALCHEMY_DATABASE_URL = os.environ.get("CHAT_APP_DATABASE_URL",
+                                         "sqlite:////" + os.path.join(base_dir, "chat_app.db"))
+# Same database through an asyncio driver (e.g. "postgresql+asyncpg://..." for Postgres)
+ASYNC_SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+# SQLite storage profile: "wal" applies SQLITE_PRAGMAS to every new connection,
+# "default" leaves SQLite's defaults (rollback journal, full sync) untouched.
+# Also set through CHAT_APP_SQLITE_PROFILE.
+SQLITE_PROFILE = os.environ.get("CHAT_APP_SQLITE_PROFILE", "wal")
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",        # readers no longer block the writer
+    "synchronous": "NORMAL",      # fsync on checkpoints only, safe with WAL
+    "busy_timeout": 5000,         # wait up to 5s for the write lock instead of failing
+    "mmap_size": 268435456,       # 256MB of the file read through mmap
+    "cache_size": -65536,         # 64MB page cache per connection
+    "temp_store": "MEMORY",
+}
+# Connection pool per process, and how often a write hitting "database is locked" is retried.
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_LOCK_RETRIES = 5
+DB_LOCK_RETRY_DELAY = 0.05
+# Signing key of the session tokens. Set CHAT_APP_SECRET_KEY to the same value for
+# every worker; without it each process makes up its own key at start up.
+SECRET_KEY = os.environ.get("CHAT_APP_SECRET_KEY", "")
+# Lifetime of a session token in seconds, and how often each process reloads
+# the list of revoked sessions.
+SESSION_TTL = 7 * 24 * 3600
+SESSION_REVOCATION_REFRESH = 5.0
+# Password hashing: bcrypt cost factor (stored hashes with another cost are
+# re-hashed on the next successful login), threads hashing in parallel, and
+# how many hash/verify calls may wait for a thread before new ones are refused.
+BCRYPT_ROUNDS = 12
+PASSWORD_HASH_WORKERS = os.cpu_count() or 2
+PASSWORD_HASH_MAX_PENDING = 64
 AI_ENABLED = True
 OPENAI_API_KEY = ""
 OPENAI_CONFIG = {
@@ -16,4 +50,93 @@ OPENAI_CONFIG = {
     "frequency_penalty": 0,
     "presence_penalty": 0
 }
-tone = "nice"
\ No newline at end of file
+tone = "nice"
+# Format of the created_at text of messages. Older rows may also hold
+# str(datetime) values; both are parsed into the sent_at column.
+TIMESTAMP_FORMAT = "%m/%d/%Y, %H:%M:%S"
+# Number of messages rendered with the chat page, and the largest page the history API returns.
+CHAT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+# Rows fetched from the database, and serialized into one chunk, at a time by chat exports.
+EXPORT_BATCH_SIZE = 1000
+# Length of the last message preview kept in each chat's summary.
+CHAT_SNIPPET_LENGTH = 100
+# Number of user id -> username entries cached in each process.
+USERNAME_CACHE_SIZE = 100000
+# AI rewrite backend: "openai", or "fake" for a local stand-in that echoes messages.
+AI_BACKEND = "openai"
+# AI rewrites: seconds to wait for the model before sending the original text,
+# and the maximum number of completion requests in flight at once.
+AI_REWRITE_TIMEOUT = 3.0
+AI_REWRITE_CONCURRENCY = 16
+# Micro-batching of concurrent rewrites into one completion request: at most
+# AI_REWRITE_BATCH_SIZE messages, collected for up to AI_REWRITE_BATCH_WINDOW seconds.
+AI_REWRITE_BATCHING = True
+AI_REWRITE_BATCH_WINDOW = 0.005
+AI_REWRITE_BATCH_SIZE = 16
+# Cache of rewrites keyed on (tone, normalized message, OPENAI_CONFIG): number of
+# entries kept in memory, their lifetime in seconds, the longest message worth
+# caching, and whether entries are also shared with other workers through the database.
+# Expired shared entries are deleted at most once every AI_REWRITE_CACHE_SWEEP_INTERVAL seconds.
+AI_REWRITE_CACHE_SIZE = 10000
+AI_REWRITE_CACHE_TTL = 3600
+AI_REWRITE_CACHE_MAX_LENGTH = 200
+AI_REWRITE_CACHE_SHARED = False
+AI_REWRITE_CACHE_SWEEP_INTERVAL = 300
+
+# Prometheus metrics at /metrics, with HTTP requests and SQL statements timed.
+# Set PROMETHEUS_MULTIPROC_DIR when running several uvicorn workers.
+METRICS_ENABLED = True
+# Opt-in query profiling (CHAT_APP_QUERY_PROFILING=1): every SQL statement of a
+# request is recorded with its duration and call site, statements run at least
+# QUERY_REPEAT_THRESHOLD times in one request are logged as likely N+1 loops,
+# and statements slower than SLOW_QUERY_THRESHOLD seconds go to the
+# "chat_app.slow_queries" log. In debug mode responses carry a summary header.
+QUERY_PROFILING = os.environ.get("CHAT_APP_QUERY_PROFILING", "") == "1"
+QUERY_REPEAT_THRESHOLD = 3
+SLOW_QUERY_THRESHOLD = 0.1
+
+# AMQP broker shared by Celery and the websocket backplane.
+BROKER_URL = "amqp://guest@broker//"
+# Backplane carrying websocket events, and changes to the cached friendships and
+# chats, between app workers: "memory" for a single process, "amqp" to run
+# several uvicorn workers behind the broker.
+BACKPLANE = "memory"
+BACKPLANE_EXCHANGE = "chat_app.events"
+
+# Write-behind persistence of chat messages: "asyncio" writes batches from an
+# in-process queue, "celery" hands each batch to the send_messages task. A batch
+# is written once PERSISTENCE_BATCH_SIZE messages are pending or
+# PERSISTENCE_FLUSH_INTERVAL seconds after its first message, whichever is first.
+PERSISTENCE_MODE = "asyncio"
+PERSISTENCE_BATCH_SIZE = 200
+PERSISTENCE_FLUSH_INTERVAL = 0.05
+PERSISTENCE_MAX_PENDING = 10000
+# Attempts at writing (or enqueuing) a batch before its senders are told it was
+# not saved, with a delay doubling from PERSISTENCE_RETRY_DELAY seconds in between.
+PERSISTENCE_WRITE_ATTEMPTS = 5
+PERSISTENCE_RETRY_DELAY = 0.1
+
+# WebSocket fan-out: size of each connection's outbound queue, and how long a
+# single send may stall before the client is considered too slow and evicted.
+WS_SEND_QUEUE_SIZE = 256
+WS_SEND_TIMEOUT = 10.0
+# Reconnect catch-up: messages per chunk of missed messages sent to a client,
+# and the most sent before telling the client to reload the page instead.
+SYNC_CHUNK_SIZE = 200
+SYNC_MAX_MESSAGES = 5000
+# Messages a worker saw on the backplane in the last SYNC_REPLAY_SECONDS (at most
+# SYNC_REPLAY_SIZE of them) are replayed after the catch-up, as other workers or
+# Celery may not have saved them yet.
+SYNC_REPLAY_SECONDS = 30.0
+SYNC_REPLAY_SIZE = 2000
+# Admission control of new websockets: accepts per second and burst of the token
+# bucket, how long a connection may wait for a token before it is turned away,
+# and the most connections one user may keep open on each worker.
+WS_ACCEPT_RATE = 200.0
+WS_ACCEPT_BURST = 100
+WS_ACCEPT_MAX_WAIT = 5.0
+WS_MAX_CONNECTIONS_PER_USER = 10
+# Presence: joins and leaves are coalesced into one event per chat every
+# WS_PRESENCE_INTERVAL seconds; a reconnect within that window is not announced.
+WS_PRESENCE_INTERVAL = 2.0
@@ -0,0 +1,123 @@
+"""
+Async counterparts of the crud functions, for async endpoints and the websocket loop.
+"""
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models
+from ..utils import password_hasher
+from .cache import membership, usernames
+
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    return await db.scalar(select(models.User).where(models.User.username == username))
+
+async def get_user(db: AsyncSession, user_id: int):
+    return await db.get(models.User, user_id)
+
+async def get_users_by_ids(db: AsyncSession, user_ids):
+    result = await db.scalars(select(models.User).where(models.User.id.in_(set(user_ids))))
+    return result.all()
+
+async def get_usernames(db: AsyncSession, user_ids):
+    """
+    Async counterpart of UsernameCache.get_many: names by user ID, loading the misses in one query.
+    """
+    user_ids = set(user_ids)
+    names = usernames.cached(user_ids)
+    missing = user_ids - names.keys()
+    if missing:
+        for user in await get_users_by_ids(db, missing):
+            names[user.id] = user.username
+            usernames.put(user.id, user.username)
+    return names
+
+async def create_user(db: AsyncSession, username: str, password: str):
+    hashed_password = await password_hasher.hash_async(password)
+    db_user = models.User(username=username, hashed_password=hashed_password)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    usernames.put(db_user.id, db_user.username)
+    return db_user
+
+async def login(db: AsyncSession, username: str, password: str):
+    db_user = await get_user_by_username(db, username)
+    if not db_user:
+        return {"status" : False, "message": "User not found"}
+
+    valid, new_hash = await password_hasher.verify_and_update_async(password, db_user.hashed_password)
+    if not valid:
+        return {"status": False, "message": "Incorrect Password"}
+    if new_hash is not None:
+        # Transparently move the stored hash to the current cost factor
+        db_user.hashed_password = new_hash
+        await db.commit()
+
+    return {"status" : True, "message": "Login successful", "user_id": db_user.id}
+
+async def create_friendship(db: AsyncSession, friend_id: int, user_id: int):
+    db_friend = models.Friend(friend_id=friend_id, user_id=user_id)
+    db.add(db_friend)
+    await db.commit()
+    await db.refresh(db_friend)
+    membership.add_friendship(user_id, friend_id)
+    return db_friend
+
+async def get_chat(db: AsyncSession, chat_id: int):
+    return await db.get(models.Chat, chat_id)
+
+async def get_chat_participants(db: AsyncSession, chat_id: int):
+    """
+    Async counterpart of crud.get_chat_participants.
+    """
+    await membership.load()
+    participants = membership.chat(chat_id)
+    if participants is None:
+        chat = await get_chat(db, chat_id)
+        if chat is None:
+            return None
+        participants = (chat.user_id, chat.friend_id)
+        membership.put_chat(chat_id, *participants)
+    return participants
+
+async def get_chat_messages(db: AsyncSession, chat_id: int, before_id: int = None, after_id: int = None,
+                            limit: int = None, since: datetime = None, until: datetime = None):
+    """
+    Async counterpart of crud.get_chat_messages.
+    """
+    query = select(models.ChatMessage).where(models.ChatMessage.chat_id == chat_id)
+    if before_id is not None:
+        query = query.where(models.ChatMessage.id < before_id)
+    if after_id is not None:
+        query = query.where(models.ChatMessage.id > after_id)
+    order = [models.ChatMessage.id]
+    if since is not None or until is not None:
+        if since is not None:
+            query = query.where(models.ChatMessage.sent_at >= since)
+        if until is not None:
+            query = query.where(models.ChatMessage.sent_at < until)
+        order = [models.ChatMessage.sent_at, models.ChatMessage.id]
+    if limit is None or after_id is not None:
+        result = await db.scalars(query.order_by(*order).limit(limit))
+        return result.all()
+    result = await db.scalars(query.order_by(*(column.desc() for column in order)).limit(limit))
+    messages = result.all()
+    messages.reverse()
+    return messages
+
+async def get_chat_messages_sent_after(db: AsyncSession, chat_id: int, sent_at: datetime, after_id: int = 0,
+                                       limit: int = None):
+    """
+    Messages of a chat from sent_at on, in (sent_at, id) order.
+
+    Messages sent exactly at sent_at are included when their id is above
+    after_id, so a page ending on a tie is continued from (its sent_at, its
+    last id) without skipping or repeating a message.
+    """
+    result = await db.scalars(select(models.ChatMessage).where(
+        models.ChatMessage.chat_id == chat_id,
+        (models.ChatMessage.sent_at > sent_at)
+        | ((models.ChatMessage.sent_at == sent_at) & (models.ChatMessage.id > after_id)),
+    ).order_by(models.ChatMessage.sent_at, models.ChatMessage.id).limit(limit))
+    return result.all()
@@ -1,16 +1,107 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import functools
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, NamedTuple, Optional
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 import sys
 from chat_app import config
 
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger("chat_app.slow_queries")
 
-engine = create_engine(
-    config.SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+
+def apply_sqlite_pragmas(engine: Engine, pragmas: dict):
+    """
+    Run the given PRAGMA statements on every new connection of a SQLite engine.
+
+    Parameters:
+    - engine: The (sync) engine; for an async engine pass its sync_engine.
+    - pragmas: PRAGMA names and values, e.g. {"journal_mode": "WAL"}.
+    """
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def make_engine(url: str = config.SQLALCHEMY_DATABASE_URL, profile: str = config.SQLITE_PROFILE,
+                **kwargs) -> Engine:
+    """
+    Create a sync engine, tuned according to the storage profile when the database is SQLite.
+
+    Parameters:
+    - url: The database URL.
+    - profile: "wal" to apply config.SQLITE_PRAGMAS, "default" to leave SQLite untouched.
+    """
+    if not url.startswith("sqlite"):
+        return create_engine(url, pool_size=config.DB_POOL_SIZE, max_overflow=config.DB_MAX_OVERFLOW, **kwargs)
+    if profile == "default":
+        return create_engine(url, connect_args={"check_same_thread": False}, **kwargs)
+    engine = create_engine(url, connect_args={"check_same_thread": False},
+                           pool_size=config.DB_POOL_SIZE, max_overflow=config.DB_MAX_OVERFLOW, **kwargs)
+    apply_sqlite_pragmas(engine, config.SQLITE_PRAGMAS)
+    return engine
+
+
+def make_async_engine(url: str = config.ASYNC_SQLALCHEMY_DATABASE_URL,
+                      profile: str = config.SQLITE_PROFILE, **kwargs):
+    """
+    Create an async engine, tuned like make_engine.
+    """
+    engine = create_async_engine(url, **kwargs)
+    if url.startswith("sqlite") and profile != "default":
+        apply_sqlite_pragmas(engine.sync_engine, config.SQLITE_PRAGMAS)
+    return engine
+
+
+def is_lock_error(error: OperationalError) -> bool:
+    return "database is locked" in str(error) or "database table is locked" in str(error)
+
+
+def retry_on_locked(f):
+    """
+    Retry a write when SQLite reports the database as locked, with exponential backoff.
+
+    The session passed as ``db`` (if any) is rolled back before each retry,
+    so the decorated function must build its changes from scratch.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        for attempt in range(config.DB_LOCK_RETRIES):
+            try:
+                return f(*args, **kwargs)
+            except OperationalError as e:
+                if not is_lock_error(e) or attempt == config.DB_LOCK_RETRIES - 1:
+                    raise
+                db = kwargs.get("db") or next((arg for arg in args if isinstance(arg, Session)), None)
+                if db is not None:
+                    db.rollback()
+                logger.warning("Database is locked, retrying %s (attempt %s)", f.__name__, attempt + 1)
+                time.sleep(config.DB_LOCK_RETRY_DELAY * 2 ** attempt)
+    return wrapper
+
+
+engine = make_engine()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Used by async endpoints and the websocket loop, so that their queries do not block the event loop
+async_engine = make_async_engine()
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 
@@ -19,4 +110,139 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+class QueryCounter:
+    """
+    Statements executed on an engine while the counter is active.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(bind=engine):
+    """
+    Count the SQL statements executed on an engine inside the block.
+
+    Usage:
+        with count_queries() as queries:
+            ...
+        assert queries.count <= 3
+    """
+    counter = QueryCounter()
+    event.listen(bind, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        event.remove(bind, "before_cursor_execute", counter)
+
+
+class ProfiledQuery(NamedTuple):
+    statement: str
+    seconds: float
+    call_site: str
+
+
+class QueryProfile:
+    """
+    Statements executed while the profile is the current one, with their
+    duration and the app code that issued them.
+    """
+
+    def __init__(self):
+        self.queries: List[ProfiledQuery] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.queries)
+
+    @property
+    def seconds(self) -> float:
+        return sum(query.seconds for query in self.queries)
+
+    def repeated(self, threshold: int = config.QUERY_REPEAT_THRESHOLD) -> Dict[str, List[ProfiledQuery]]:
+        """
+        Statements run at least threshold times, the usual sign of a query issued in a loop.
+
+        Returns:
+        - dict: The executions of each repeated statement, by statement text.
+        """
+        by_statement = defaultdict(list)
+        for query in self.queries:
+            by_statement[query.statement].append(query)
+        return {statement: queries for statement, queries in by_statement.items() if len(queries) >= threshold}
+
+
+# Profile of the request being handled, set by profiling.QueryProfilerMiddleware
+current_profile: ContextVar[Optional[QueryProfile]] = ContextVar("current_profile", default=None)
+
+_APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def call_site(depth: int = 3) -> str:
+    """
+    The innermost frames of app code on the stack, skipping SQLAlchemy and this module.
+
+    Returns:
+    - str: e.g. "db/crud.py:42 in get_user < api/users.py:51 in read_user".
+    """
+    frame, sites = sys._getframe(1), []
+    while frame is not None and len(sites) < depth:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_APP_DIR) and filename != __file__:
+            sites.append(f"{os.path.relpath(filename, _APP_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}")
+        frame = frame.f_back
+    # Queries of the async engine run in a greenlet, whose stack stops at the driver
+    return " < ".join(sites) or "unknown"
+
+
+def profile_queries(bind: Engine, slow_threshold: float = config.SLOW_QUERY_THRESHOLD):
+    """
+    Record the statements of an engine in the current profile, and log the slow ones.
+
+    Slow statements are logged to "chat_app.slow_queries" as one JSON object
+    per line, whether or not a profile is active.
+
+    Parameters:
+    - bind: A sync engine; for an async engine pass its sync_engine.
+    - slow_threshold: Duration in seconds from which a statement is logged.
+    """
+    @event.listens_for(bind, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        context._profile_started = time.perf_counter()
+
+    @event.listens_for(bind, "after_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_profile_started", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        profile = current_profile.get()
+        if profile is None and elapsed < slow_threshold:
+            return
+        site = call_site()
+        if profile is not None:
+            profile.queries.append(ProfiledQuery(statement, elapsed, site))
+        if elapsed >= slow_threshold:
+            slow_query_logger.warning(json.dumps({
+                "event": "slow_query",
+                "duration_ms": round(elapsed * 1000, 2),
+                "statement": " ".join(statement.split()),
+                "executemany": executemany,
+                "call_site": site,
+            }))
@@ -0,0 +1,207 @@
+"""
+Process-local caches in front of the database.
+"""
+import asyncio
+import threading
+import uuid
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+from sqlalchemy.orm import Session
+from chat_app import config
+from . import models
+from .base import SessionLocal
+
+
+class UsernameCache:
+    """
+    Bounded id -> username cache.
+
+    Misses are loaded with a single ``IN (...)`` query, so resolving the
+    names of any number of users costs at most one round trip. Entries are
+    updated by crud when users are created or deleted.
+    """
+
+    def __init__(self, max_size: int = config.USERNAME_CACHE_SIZE):
+        self.max_size = max_size
+        self._names: "OrderedDict[int, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, user_id: int) -> Optional[str]:
+        """
+        Get the username of a user, or None if the user does not exist.
+        """
+        return self.get_many(db, [user_id]).get(user_id)
+
+    def get_many(self, db: Session, user_ids: Iterable[int]) -> Dict[int, str]:
+        """
+        Get the usernames of several users, keyed by user ID; unknown IDs are left out.
+        """
+        user_ids = set(user_ids)
+        names = self.cached(user_ids)
+        missing = user_ids - names.keys()
+        if missing:
+            rows = db.query(models.User.id, models.User.username).filter(models.User.id.in_(missing))
+            for user_id, username in rows:
+                names[user_id] = username
+                self.put(user_id, username)
+        return names
+
+    def cached(self, user_ids: Iterable[int]) -> Dict[int, str]:
+        """
+        Get the usernames of the users that are already cached, without touching the database.
+        """
+        with self._lock:
+            names = {user_id: self._names[user_id] for user_id in user_ids if user_id in self._names}
+            for user_id in names:
+                self._names.move_to_end(user_id)
+        return names
+
+    def put(self, user_id: int, username: str):
+        with self._lock:
+            self._names[user_id] = username
+            self._names.move_to_end(user_id)
+            while len(self._names) > self.max_size:
+                self._names.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._names.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
+
+
+
+class MembershipCache:
+    """
+    Who is friends with whom, and who the two participants of each chat are.
+
+    The whole graph is loaded with two queries on start up (or on first
+    use), then kept up to date by crud as friendships, chats and users are
+    created and deleted, so that membership checks never touch the database.
+    Chats missing from the cache, e.g. created by a script, are looked up by
+    crud and added on the way.
+
+    With several workers, set ``publish`` to a function sending changes to
+    the other workers, which hand them to ``apply``; the socket manager does
+    so over the backplane.
+
+    Code running on the event loop awaits ``load`` before reading, so that a
+    read before the start up load has finished does not block the loop.
+    """
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self.publish: Optional[Callable[[dict], None]] = None
+        self._friends: Dict[int, Set[int]] = defaultdict(set)
+        self._chats: Dict[int, Tuple[int, int]] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def warm(self, db: Optional[Session] = None):
+        """
+        (Re)load every friendship and chat in bulk.
+        """
+        own_session = db is None
+        db = SessionLocal() if own_session else db
+        try:
+            friends = defaultdict(set)
+            for user_id, friend_id in db.query(models.Friend.user_id, models.Friend.friend_id):
+                friends[user_id].add(friend_id)
+                friends[friend_id].add(user_id)
+            chats = {chat_id: (user_id, friend_id) for chat_id, user_id, friend_id in
+                     db.query(models.Chat.id, models.Chat.user_id, models.Chat.friend_id)}
+        finally:
+            if own_session:
+                db.close()
+        with self._lock:
+            self._friends, self._chats, self._loaded = friends, chats, True
+
+    async def load(self):
+        """
+        Load the graph off the event loop, unless it already is.
+        """
+        if not self._loaded:
+            await asyncio.to_thread(self._ensure_loaded)
+
+    def are_friends(self, user_id: int, friend_id: int) -> bool:
+        """
+        Whether two users are friends, whichever of them added the other.
+        """
+        self._ensure_loaded()
+        return friend_id in self._friends.get(user_id, ())
+
+    def chat(self, chat_id: int) -> Optional[Tuple[int, int]]:
+        """
+        Get the (user_id, friend_id) participants of a chat, or None if it is not cached.
+        """
+        self._ensure_loaded()
+        return self._chats.get(chat_id)
+
+    def is_member(self, chat_id: int, user_id: int) -> bool:
+        participants = self.chat(chat_id)
+        return participants is not None and user_id in participants
+
+    def put_chat(self, chat_id: int, user_id: int, friend_id: int):
+        """
+        Cache a chat read from the database, without telling the other workers.
+        """
+        with self._lock:
+            self._chats[chat_id] = (user_id, friend_id)
+
+    def add_friendship(self, user_id: int, friend_id: int):
+        self._change({"op": "friendship", "user_id": user_id, "friend_id": friend_id, "friends": True})
+
+    def remove_friendship(self, user_id: int, friend_id: int):
+        self._change({"op": "friendship", "user_id": user_id, "friend_id": friend_id, "friends": False})
+
+    def add_chat(self, chat_id: int, user_id: int, friend_id: int):
+        self._change({"op": "chat", "chat_id": chat_id, "user_id": user_id, "friend_id": friend_id})
+
+    def remove_user(self, user_id: int):
+        # crud deletes the friendships of the user along with it; chats are kept
+        self._change({"op": "user_deleted", "user_id": user_id})
+
+    def apply(self, change: dict):
+        """
+        Apply a change made by another worker; changes made by this one are already applied.
+        """
+        if change.get("origin") == self.origin:
+            return
+        op = change["op"]
+        with self._lock:
+            if op == "friendship":
+                user_id, friend_id = change["user_id"], change["friend_id"]
+                if change["friends"]:
+                    self._friends[user_id].add(friend_id)
+                    self._friends[friend_id].add(user_id)
+                else:
+                    self._friends[user_id].discard(friend_id)
+                    self._friends[friend_id].discard(user_id)
+            elif op == "chat":
+                self._chats[change["chat_id"]] = (change["user_id"], change["friend_id"])
+            elif op == "user_deleted":
+                for friend_id in self._friends.pop(change["user_id"], ()):
+                    self._friends[friend_id].discard(change["user_id"])
+
+    def clear(self):
+        with self._lock:
+            self._friends, self._chats, self._loaded = defaultdict(set), {}, False
+
+    def _change(self, change: dict):
+        self.apply(change)
+        if self.publish is not None:
+            self.publish(dict(change, origin=self.origin))
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            # Callers arriving while the graph loads wait for it instead of loading it again
+            with self._load_lock:
+                if not self._loaded:
+                    self.warm()
+
+
+usernames = UsernameCache()
+membership = MembershipCache()
@@ -1,9 +1,13 @@
 import logging
+from datetime import datetime
+from sqlalchemy import Integer, bindparam, case, delete, func, insert, select, update
 from sqlalchemy.orm import Session
 from . import models, schemas
+from .. import config
 from fastapi import HTTPException, status
-from ..utils import verify_password, hash_password
-from .base import get_db
+from ..utils import hash_password, parse_timestamp, password_hasher
+from .base import SessionLocal, retry_on_locked
+from .cache import membership, usernames
 
 def handle_exception(f):
     def wrapper(*args, **kwargs):
@@ -24,45 +28,72 @@ def get_username_by_id(db: Session, user_id: int):
 def get_user(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
 
-def get_users(db: Session):
-    return db.query(models.User).all()
+def paginate(query, column, skip: int = 0, limit: int = None, after_id: int = None):
+    """
+    Apply limit/offset, or keyset pagination when after_id is given, ordered by column.
+    """
+    query = query.order_by(column)
+    if after_id is not None:
+        query = query.filter(column > after_id)
+    elif skip:
+        query = query.offset(skip)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
 
+def get_users_by_ids(db: Session, user_ids):
+    return db.query(models.User).filter(models.User.id.in_(set(user_ids))).all()
+
+def get_users(db: Session, skip: int = 0, limit: int = None, after_id: int = None):
+    return paginate(db.query(models.User), models.User.id, skip=skip, limit=limit, after_id=after_id)
+
+@retry_on_locked
 def create_user(db: Session, username: str, password: str):
     hashed_password = hash_password(password)
     db_user = models.User(username=username, hashed_password=hashed_password)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    usernames.put(db_user.id, db_user.username)
     return db_user
 
 
+def check_password(db: Session, db_user: models.User, password: str) -> bool:
+    """
+    Verify a user's password, re-hashing it if its stored hash predates the current policy.
+    """
+    valid, new_hash = password_hasher.verify_and_update(password, db_user.hashed_password)
+    if valid and new_hash is not None:
+        db_user.hashed_password = new_hash
+        db.commit()
+    return valid
+
 def authenticate_user(db: Session, username: str, password: str):
     user = get_user_by_username(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not check_password(db, user, password):
         return False
     return user
 
 def get_friendship(db: Session, id: int):
     return db.query(models.Friend).filter(models.Friend.id == id).first()
 
+@retry_on_locked
 def create_friendship(db: Session, friend_id: int, user_id: int):
     db_friend = models.Friend(friend_id=friend_id, user_id=user_id)
     db.add(db_friend)
     db.commit()
     db.refresh(db_friend)
+    membership.add_friendship(user_id, friend_id)
     return db_friend
 
-def get_friends(db: Session, user_id: int):
-    return db.query(models.Friend).filter(models.Friend.user_id == user_id).all()
+def get_friends(db: Session, user_id: int, skip: int = 0, limit: int = None, after_id: int = None):
+    query = db.query(models.Friend).filter(models.Friend.user_id == user_id)
+    return paginate(query, models.Friend.id, skip=skip, limit=limit, after_id=after_id)
 
 def get_friendship_by_users(db: Session, user_id: int, friend_id: int):
-    friendship_query = db.query(models.Friend).filter((
-                                                                  models.Friend.user_id == user_id and models.Friend.friend_id == friend_id) | \
-                                                      (
-                                                                  models.Friend.user_id == friend_id and models.Friend.friend_id == user_id))
-    return friendship_query.first()
+    return db.query(models.Friend).filter(friendship_between(user_id, friend_id)).order_by(models.Friend.id).first()
 
 def check_is_friend(db: Session, user_id: int):
     return db.query(models.Friend).filter(models.Friend.user_id == user_id)\
@@ -70,81 +101,326 @@ def check_is_friend(db: Session, user_id: int):
 
 def get_chats_by_users(db: Session, user_id: int, friend_id: int = None):
     if friend_id is None:
-        query = db.query(models.Chat)
-        return query.all()
-    return db.query(models.Chat).filter((models.Chat.user_id == user_id and models.Chat.friend_id == friend_id) |
-                                        models.Chat.friend_id == user_id and
-                                        models.Chat.user_id == friend_id).all()
+        return db.query(models.Chat).filter((models.Chat.user_id == user_id) |
+                                            (models.Chat.friend_id == user_id)).order_by(models.Chat.id).all()
+    return get_chat_for_users(db, user_id=user_id, friend_id=friend_id)
 def get_chat(db: Session, chat_id: int):
     return db.query(models.Chat).filter(models.Chat.id == chat_id).first()
 
-def get_chats_all(db: Session):
-    return db.query(models.Chat).all()
+def get_chats_all(db: Session, skip: int = 0, limit: int = None, after_id: int = None):
+    return paginate(db.query(models.Chat), models.Chat.id, skip=skip, limit=limit, after_id=after_id)
 
+@retry_on_locked
 def create_chat(db: Session, chat: schemas.ChatCreate):
     db_chat = models.Chat(**chat.dict())
     db.add(db_chat)
     db.commit()
     db.refresh(db_chat)
+    membership.add_chat(db_chat.id, db_chat.user_id, db_chat.friend_id)
     return db_chat
 
 
 def get_chat_for_users(db: Session, user_id: int, friend_id: int):
+    # A probe of the unique index on the ordered pair of users
+    low, high = models.ordered_pair(models.Chat.user_id, models.Chat.friend_id)
     return (
         db.query(models.Chat)
-        .filter(
-            ((models.Chat.friend_id == user_id) & (models.Chat.user_id == friend_id))
-            | ((models.Chat.friend_id == friend_id) & (models.Chat.user_id == user_id))
-        )
+        .filter(low == min(user_id, friend_id), high == max(user_id, friend_id))
         .order_by(models.Chat.id)
         .all()
     )
 
+def friendship_between(user_id, friend_id):
+    """
+    Filter on the friendships between two users (or user id expressions), in either direction.
+    """
+    return (((models.Friend.user_id == user_id) & (models.Friend.friend_id == friend_id))
+            | ((models.Friend.user_id == friend_id) & (models.Friend.friend_id == user_id)))
+
+def get_new_chat_check(db: Session, user_id: int, friend_id: int):
+    """
+    Everything creating a chat between two users depends on, in one query.
+
+    Returns:
+    - Row: user_id and friend_id (None for a user that does not exist), the
+      friendship_id of the two users and the chat_id of their existing chat
+      (None if there is none).
+    """
+    low, high = models.ordered_pair(models.Chat.user_id, models.Chat.friend_id)
+    return db.query(
+        select(models.User.id).where(models.User.id == user_id).scalar_subquery().label("user_id"),
+        select(models.User.id).where(models.User.id == friend_id).scalar_subquery().label("friend_id"),
+        select(models.Friend.id).where(friendship_between(user_id, friend_id))
+        .limit(1).scalar_subquery().label("friendship_id"),
+        select(models.Chat.id).where(low == min(user_id, friend_id), high == max(user_id, friend_id))
+        .order_by(models.Chat.id).limit(1).scalar_subquery().label("chat_id"),
+    ).one()
+
+def get_chat_participants(db: Session, chat_id: int):
+    """
+    The (user_id, friend_id) participants of a chat from the membership cache, or None if it does not exist.
+    """
+    participants = membership.chat(chat_id)
+    if participants is None:
+        chat = get_chat(db, chat_id)
+        if chat is None:
+            return None
+        participants = (chat.user_id, chat.friend_id)
+        membership.put_chat(chat_id, *participants)
+    return participants
+
 logger = logging.getLogger(__name__)
 
 def create_message(message: schemas.MessageCreate):
     try:
-        db = next(get_db())
-        db_message = models.ChatMessage(**message)
-        db.add(db_message)
-        db.commit()
-        print("Here")
-        print(db_message)
+        # Also accepts the dict a message is queued as
+        create_messages([dict(message)])
     except Exception as e:
-        print(e)
+        logger.exception("Failed to save message")
+        return schemas.ResponseMessage(success=False, message=str(e))
     return schemas.ResponseMessage(success=True, message="Message sent successfully")
 
+@retry_on_locked
+def create_messages(messages):
+    """
+    Insert a batch of messages with one multi-row insert in a single transaction.
+
+    The rows are inserted in the given order, so their ids follow it.
+    """
+    rows = [{"chat_id": int(message["chat_id"]), "sender_id": int(message["sender_id"]),
+             "message": message["message"], "created_at": message["created_at"],
+             "sent_at": parse_timestamp(message.get("sent_at") or message["created_at"])}
+            for message in messages]
+    if not rows:
+        return 0
+    db = SessionLocal()
+    try:
+        # Ids are handed out in the order of the rows, so sorting the returned
+        # ones matches them up; asking SQLAlchemy to keep the parameter order
+        # instead makes it insert one row per statement on SQLite
+        ids = sorted(db.scalars(insert(models.ChatMessage).returning(models.ChatMessage.id), rows).all())
+        for row, message_id in zip(rows, ids):
+            row["id"] = message_id
+        update_chat_summaries(db, rows)
+        db.commit()
+    finally:
+        db.close()
+    return len(rows)
+
+def update_chat_summaries(db: Session, rows):
+    """
+    Fold newly inserted messages into the summaries and read states of their chats.
+
+    Sending a message marks the chat as read for its sender; every other
+    participant gets one more unread message. Runs in the caller's transaction.
+
+    The batch is folded per chat and per participant first, so that each
+    table gets one executemany UPDATE, plus one INSERT for the rows that do
+    not exist yet, whatever the number of messages.
+    """
+    rows = sorted(rows, key=lambda row: row["id"])
+    chat_ids = {row["chat_id"] for row in rows}
+    participants = {chat_id: {user_id, friend_id} for chat_id, user_id, friend_id in
+                    db.query(models.Chat.id, models.Chat.user_id, models.Chat.friend_id)
+                    .filter(models.Chat.id.in_(chat_ids))}
+    summaries, states = {}, {}
+    for row in rows:
+        chat_id = row["chat_id"]
+        summary = summaries.setdefault(chat_id, {"chat_id": chat_id, "message_count": 0})
+        summary.update(last_message_id=row["id"], last_sender_id=row["sender_id"],
+                       snippet=row["message"][:config.CHAT_SNIPPET_LENGTH], last_created_at=row["created_at"])
+        summary["message_count"] += 1
+        for user_id in participants.get(chat_id, set()) | {row["sender_id"]}:
+            # last_read_id stays None for a participant who only received messages
+            state = states.setdefault((chat_id, user_id), {"chat_id": chat_id, "user_id": user_id,
+                                                           "last_read_id": None, "unread_count": 0})
+            if user_id == row["sender_id"]:
+                state["last_read_id"] = row["id"]
+                state["unread_count"] = 0
+            else:
+                state["unread_count"] += 1
+
+    existing = {chat_id for chat_id, in
+                db.query(models.ChatSummary.chat_id).filter(models.ChatSummary.chat_id.in_(chat_ids))}
+    existing_states = {(chat_id, user_id) for chat_id, user_id in
+                       db.query(models.ChatReadState.chat_id, models.ChatReadState.user_id)
+                       .filter(models.ChatReadState.chat_id.in_(chat_ids))}
+
+    table = models.ChatSummary.__table__
+    added = [summary for chat_id, summary in summaries.items() if chat_id not in existing]
+    if added:
+        db.execute(insert(table), added)
+    changed = [{"b_chat_id": summary["chat_id"], "b_added": summary["message_count"],
+                "last_message_id": summary["last_message_id"], "last_sender_id": summary["last_sender_id"],
+                "snippet": summary["snippet"], "last_created_at": summary["last_created_at"]}
+               for chat_id, summary in summaries.items() if chat_id in existing]
+    if changed:
+        db.execute(update(table).where(table.c.chat_id == bindparam("b_chat_id"))
+                   .values(message_count=table.c.message_count + bindparam("b_added")), changed)
+
+    table = models.ChatReadState.__table__
+    added = [dict(state, last_read_id=state["last_read_id"] or 0)
+             for key, state in states.items() if key not in existing_states]
+    if added:
+        db.execute(insert(table), added)
+    changed = [{"b_chat_id": chat_id, "b_user_id": user_id, "b_read_id": state["last_read_id"],
+                "b_unread": state["unread_count"]}
+               for (chat_id, user_id), state in states.items() if (chat_id, user_id) in existing_states]
+    if changed:
+        # A participant who sent a message is reset to it, the others count up
+        read_id, unread = bindparam("b_read_id", type_=Integer), bindparam("b_unread", type_=Integer)
+        db.execute(update(table).where(table.c.chat_id == bindparam("b_chat_id"),
+                                       table.c.user_id == bindparam("b_user_id"))
+                   .values(last_read_id=func.coalesce(read_id, table.c.last_read_id),
+                           unread_count=case((read_id.is_(None), table.c.unread_count + unread), else_=unread)),
+                   changed)
+
+def get_chat_overviews(db: Session, user_id: int):
+    """
+    Chats of a user with their summary and the user's read state, most recently active first.
+
+    One query over the chats of the user; summaries and read states are
+    looked up by primary key, whatever the size of the history.
+    """
+    return (
+        db.query(models.Chat, models.ChatSummary, models.ChatReadState)
+        .outerjoin(models.ChatSummary, models.ChatSummary.chat_id == models.Chat.id)
+        .outerjoin(models.ChatReadState, (models.ChatReadState.chat_id == models.Chat.id)
+                   & (models.ChatReadState.user_id == user_id))
+        .filter((models.Chat.user_id == user_id) | (models.Chat.friend_id == user_id))
+        .order_by(func.coalesce(models.ChatSummary.last_message_id, 0).desc(), models.Chat.id.desc())
+        .all()
+    )
+
+@retry_on_locked
+def mark_chat_read(db: Session, chat_id: int, user_id: int, message_id: int = None):
+    """
+    Move a user's read cursor forward to message_id, or to the latest message of the chat.
+
+    Returns:
+    - models.ChatReadState: The updated read state.
+    """
+    summary = db.get(models.ChatSummary, chat_id)
+    last_message_id = (summary.last_message_id or 0) if summary is not None else 0
+    read_id = last_message_id if message_id is None else min(message_id, last_message_id)
+    state = db.get(models.ChatReadState, (chat_id, user_id))
+    if state is None:
+        state = models.ChatReadState(chat_id=chat_id, user_id=user_id, last_read_id=0, unread_count=0)
+        db.add(state)
+    if read_id > state.last_read_id:
+        state.last_read_id = read_id
+        if read_id >= last_message_id:
+            state.unread_count = 0
+        else:
+            # Counts the messages after the cursor only, on the (chat_id, id) index
+            state.unread_count = db.query(func.count(models.ChatMessage.id)).filter(
+                models.ChatMessage.chat_id == chat_id, models.ChatMessage.id > read_id,
+                models.ChatMessage.sender_id != user_id).scalar()
+    db.commit()
+    return state
+
 @handle_exception
+@retry_on_locked
 def delete_user(db: Session, user_id: int):
     db_user = db.query(models.User).filter(models.User.id == user_id).first()
     if not db_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    # Friendships go with the user, or the next load of the membership cache would bring them back
+    db.query(models.Friend).filter((models.Friend.user_id == user_id) | (models.Friend.friend_id == user_id))\
+        .delete(synchronize_session=False)
     db.delete(db_user)
     db.commit()
-    return schemas.ResponseMessage(success=True, message="Friendship deleted successfully")
+    usernames.invalidate(user_id)
+    membership.remove_user(user_id)
+    return schemas.ResponseMessage(success=True, message="User deleted successfully")
 
 @handle_exception
+@retry_on_locked
 def delete_friendship(db: Session, friendship_id: int):
     db_friendship = db.query(models.Friend).filter(models.Friend.id == friendship_id).first()
     if not db_friendship:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Friendship not found")
+    user_id, friend_id = db_friendship.user_id, db_friendship.friend_id
     db.delete(db_friendship)
     db.commit()
+    # Users who added each other twice stay friends through the other row
+    if get_friendship_by_users(db, user_id=user_id, friend_id=friend_id) is None:
+        membership.remove_friendship(user_id, friend_id)
     return schemas.ResponseMessage(success=True, message="Friendship deleted successfully")
 
-def get_chat_messages(db: Session, chat_id: int):
-    messages = db.query(models.ChatMessage).filter(
-        models.ChatMessage.chat_id == chat_id
-    ).order_by(models.ChatMessage.id).all()
+def get_chat_messages(db: Session, chat_id: int, before_id: int = None, after_id: int = None,
+                      limit: int = None, since: datetime = None, until: datetime = None):
+    """
+    Keyset paginated history of a chat, in ascending id order.
 
+    With a limit and no after_id the latest messages (before before_id, if
+    given) are returned; with after_id the oldest messages after it are.
+    since and until restrict the messages to [since, until) and make the
+    query a range scan of the (chat_id, sent_at) index, ordered by sent_at.
+    """
+    query = db.query(models.ChatMessage).filter(models.ChatMessage.chat_id == chat_id)
+    if before_id is not None:
+        query = query.filter(models.ChatMessage.id < before_id)
+    if after_id is not None:
+        query = query.filter(models.ChatMessage.id > after_id)
+    order = [models.ChatMessage.id]
+    if since is not None or until is not None:
+        if since is not None:
+            query = query.filter(models.ChatMessage.sent_at >= since)
+        if until is not None:
+            query = query.filter(models.ChatMessage.sent_at < until)
+        order = [models.ChatMessage.sent_at, models.ChatMessage.id]
+    if limit is None or after_id is not None:
+        query = query.order_by(*order)
+        return query.limit(limit).all() if limit is not None else query.all()
+    messages = query.order_by(*(column.desc() for column in order)).limit(limit).all()
+    messages.reverse()
     return messages
 
+def iter_chat_messages(db: Session, chat_id: int, batch_size: int = config.EXPORT_BATCH_SIZE):
+    """
+    Every message of a chat in id order, as rows fetched batch_size at a time.
+
+    Only the columns are loaded, not ORM objects, so nothing piles up in the
+    session while the rows are consumed.
+    """
+    message = models.ChatMessage
+    return (db.query(message.id, message.sender_id, message.chat_id, message.message,
+                     message.created_at, message.sent_at)
+            .filter(message.chat_id == chat_id)
+            .order_by(message.id)
+            .yield_per(batch_size))
+
+def get_rewrite_cache_entry(db: Session, key: str, now: float):
+    return db.query(models.RewriteCacheEntry).filter(models.RewriteCacheEntry.key == key,
+                                                      models.RewriteCacheEntry.expires_at > now).first()
+
+@retry_on_locked
+def set_rewrite_cache_entry(db: Session, key: str, value: str, expires_at: float):
+    db.merge(models.RewriteCacheEntry(key=key, value=value, expires_at=expires_at))
+    db.commit()
+
+@retry_on_locked
+def delete_expired_rewrite_cache_entries(db: Session, now: float) -> int:
+    result = db.execute(delete(models.RewriteCacheEntry).where(models.RewriteCacheEntry.expires_at <= now))
+    db.commit()
+    return result.rowcount
+
+@retry_on_locked
+def revoke_session(db: Session, session_id: str, expires_at: float):
+    db.merge(models.RevokedSession(session_id=session_id, expires_at=expires_at))
+    db.commit()
+
+def get_revoked_sessions(db: Session, now: float):
+    rows = db.query(models.RevokedSession.session_id).filter(models.RevokedSession.expires_at > now)
+    return {session_id for session_id, in rows}
+
 def login(db, username: str, password: str):
     db_user = db.query(models.User).filter(models.User.username == username).first()
     if not db_user:
         return {"status" : False, "message": "User not found"}
 
-    if not verify_password(password, db_user.hashed_password):
+    if not check_password(db, db_user, password):
         return {"status": False, "message": "Incorrect Password"}
 
     return {"status" : True, "message": "Login successful"}
\ No newline at end of file
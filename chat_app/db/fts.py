@@ -0,0 +1,224 @@
+"""
+Full-text search over chat messages, backed by an SQLite FTS5 index.
+
+The index is an external content table over ``chat_messages``: it stores
+only the tokens, and triggers keep it in step with every insert, update and
+delete, whichever code path writes the messages. Besides the words of the
+message it indexes the chat as a "c<id>" token, so that a search scoped to
+the chats of a user is an intersection of posting lists inside the index,
+rather than a filter over every message matching a common word.
+
+Rebuild the index of an existing database with:
+
+    python -m chat_app.db.fts rebuild
+"""
+import argparse
+import html
+import logging
+from typing import Iterable, List
+from sqlalchemy import DateTime, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+TABLE = "chat_messages_fts"
+
+# Shortest prefix searched for with a trailing "*".
+MIN_PREFIX_LENGTH = 3
+
+# Markers put around matched terms by snippet(); replaced once the text is escaped.
+_START, _END = "\x02", "\x03"
+
+_SCHEMA = [
+    f"""CREATE VIEW IF NOT EXISTS {TABLE}_content AS
+        SELECT id, message, 'c' || chat_id AS chat FROM chat_messages""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5(
+        message, chat, content='{TABLE}_content', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""",
+    f"""CREATE TRIGGER IF NOT EXISTS {TABLE}_insert AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO {TABLE}(rowid, message, chat) VALUES (new.id, new.message, 'c' || new.chat_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {TABLE}_delete AFTER DELETE ON chat_messages BEGIN
+        INSERT INTO {TABLE}({TABLE}, rowid, message, chat) VALUES ('delete', old.id, old.message, 'c' || old.chat_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {TABLE}_update AFTER UPDATE OF message, chat_id ON chat_messages BEGIN
+        INSERT INTO {TABLE}({TABLE}, rowid, message, chat) VALUES ('delete', old.id, old.message, 'c' || old.chat_id);
+        INSERT INTO {TABLE}(rowid, message, chat) VALUES (new.id, new.message, 'c' || new.chat_id);
+    END""",
+]
+
+# Orders and pages the matches first, then builds the snippets of the page
+# only, as SQLite would otherwise compute the snippet of every match before
+# sorting them. Snippets only need the words, not the chat scope; CROSS JOIN
+# keeps SQLite from scanning every message matching the words instead.
+_SEARCH = f"""
+    WITH page AS (
+        SELECT rowid AS id, {{rank}} AS rank FROM {TABLE}
+        WHERE {TABLE} MATCH :query
+        ORDER BY {{order}}
+        LIMIT :limit OFFSET :offset
+    )
+    SELECT m.id, m.chat_id, m.sender_id, m.message, m.created_at, m.sent_at,
+           snippet({TABLE}, 0, :start, :end, '…', :tokens) AS snippet, page.rank
+    FROM page
+    CROSS JOIN {TABLE} ON {TABLE}.rowid = page.id AND {TABLE} MATCH :words
+    JOIN chat_messages AS m ON m.id = page.id
+    ORDER BY {{page_order}}
+"""
+
+# bm25 counts every message containing each word, which takes tens of
+# milliseconds for the most common words of a large history; newest first
+# walks the index backwards and stops at the end of the page. The chat column
+# only scopes the search, so it is left out of the ranking.
+ORDERS = {
+    "relevance": text(_SEARCH.format(rank=f"bm25({TABLE}, 1.0, 0.0)", order="rank, id DESC",
+                                     page_order="page.rank, page.id DESC")).columns(sent_at=DateTime),
+    "recent": text(_SEARCH.format(rank="0.0", order="id DESC", page_order="page.id DESC")).columns(sent_at=DateTime),
+}
+
+_CHATS_OF_USER = text("SELECT id FROM chats WHERE user_id = :user_id OR friend_id = :user_id")
+
+
+class SearchUnavailable(Exception):
+    """
+    Raised when the database has no full-text index.
+    """
+
+
+def is_supported(engine: Engine) -> bool:
+    return engine.dialect.name == "sqlite"
+
+
+def exists(engine: Engine) -> bool:
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                            {"name": TABLE}).first() is not None
+
+
+def create(engine: Engine) -> bool:
+    """
+    Create the index and its triggers, filling the index from the existing messages.
+
+    Parameters:
+    - engine: The engine of the database.
+
+    Returns:
+    - bool: True if the index is in place, False if the database can not have one.
+    """
+    if not is_supported(engine):
+        return False
+    created = not exists(engine)
+    try:
+        with engine.begin() as conn:
+            for statement in _SCHEMA:
+                conn.execute(text(statement))
+    except OperationalError:
+        logger.warning("SQLite was built without FTS5, message search is disabled")
+        return False
+    if created:
+        rebuild(engine)
+    return True
+
+
+def rebuild(engine: Engine):
+    """
+    Re-index every message from the content of ``chat_messages``.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"INSERT INTO {TABLE}({TABLE}) VALUES ('rebuild')"))
+
+
+def optimize(engine: Engine):
+    """
+    Merge the index segments, which speeds queries up after large imports.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"INSERT INTO {TABLE}({TABLE}) VALUES ('optimize')"))
+
+
+def to_match_query(terms: str) -> str:
+    """
+    Turn free text into an FTS5 query for messages that contain every word.
+
+    Each word is quoted so that FTS5 operators typed by users are taken
+    literally. A word ending with "*" matches as a prefix, provided it is long
+    enough not to expand to a large part of the vocabulary.
+    """
+    words = []
+    for word in terms.split():
+        prefix = word.endswith("*") and len(word.rstrip("*")) >= MIN_PREFIX_LENGTH
+        word = word.rstrip("*")
+        if word:
+            words.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not words:
+        return ""
+    return f"message : ({' '.join(words)})"
+
+
+def to_scope_query(chat_ids: Iterable[int]) -> str:
+    """
+    Build an FTS5 query for the messages of any of the given chats.
+    """
+    chats = " OR ".join(f'"c{int(chat_id)}"' for chat_id in chat_ids)
+    return f"chat : ({chats})"
+
+
+def highlight(snippet: str) -> str:
+    """
+    Escape a snippet for HTML and wrap the matched terms in <mark> tags.
+    """
+    return html.escape(snippet).replace(_START, "<mark>").replace(_END, "</mark>")
+
+
+def search(db: Session, user_id: int, terms: str, chat_id: int = None, order: str = "relevance",
+           limit: int = 20, offset: int = 0, snippet_tokens: int = 12) -> List[dict]:
+    """
+    Search the messages of the chats a user takes part in.
+
+    Parameters:
+    - db: The database session.
+    - user_id: The ID of the user searching.
+    - terms: The words to look for.
+    - chat_id: Only search this chat, if given.
+    - order: "relevance" for the best matches first, or "recent" for the newest first.
+    - limit: Maximum number of results.
+    - offset: Number of results to skip (for pagination).
+    - snippet_tokens: Number of words in each highlight snippet.
+
+    Returns:
+    - List[dict]: The matching messages, with an HTML "snippet" and their "rank".
+    """
+    chat_ids = {row_id for row_id, in db.execute(_CHATS_OF_USER, {"user_id": user_id})}
+    if chat_id is not None:
+        chat_ids &= {chat_id}
+    words = to_match_query(terms)
+    if not words or not chat_ids:
+        return []
+    try:
+        rows = db.execute(ORDERS[order], {"query": f"{words} AND {to_scope_query(chat_ids)}", "words": words,
+                                          "limit": limit, "offset": offset, "tokens": snippet_tokens,
+                                          "start": _START, "end": _END}).mappings().all()
+    except OperationalError as e:
+        if f"no such table: {TABLE}" in str(e):
+            raise SearchUnavailable("Message search is not available") from e
+        raise
+    return [dict(row, snippet=highlight(row["snippet"])) for row in rows]
+
+
+def main():
+    from .base import engine
+    parser = argparse.ArgumentParser(description="Maintain the full-text index of chat messages.")
+    parser.add_argument("command", choices=["rebuild", "optimize"])
+    args = parser.parse_args()
+    if not create(engine):
+        parser.exit(1, "Full-text search is not supported by this database\n")
+    if args.command == "rebuild":
+        rebuild(engine)
+    else:
+        optimize(engine)
+
+
+if __name__ == "__main__":
+    main()
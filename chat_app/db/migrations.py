@@ -0,0 +1,165 @@
+"""
+In-place upgrades of an existing database to the current models.
+
+``Base.metadata.create_all`` only creates missing tables, so columns and
+indexes added to tables that already exist are created here, and data derived
+later on is filled in from the existing rows.
+"""
+import logging
+from sqlalchemy import func, inspect, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from .. import config
+from ..utils import parse_timestamp
+from .base import Base
+from . import fts, models  # noqa: F401  (models registers the tables on Base.metadata)
+
+logger = logging.getLogger(__name__)
+
+# Number of chats whose summaries, or of messages whose timestamps, are
+# backfilled per transaction.
+BACKFILL_BATCH_SIZE = 500
+SENT_AT_BACKFILL_BATCH_SIZE = 5000
+
+
+def add_missing_columns(engine: Engine):
+    """
+    Add the columns declared on the models that are missing from existing tables.
+
+    Only nullable columns without server defaults can be added this way,
+    which is how new columns are declared.
+
+    Parameters:
+    - engine: The engine of the database to upgrade.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
+def create_missing_indexes(engine: Engine):
+    """
+    Create every index declared on the models that is missing from the database.
+
+    Parameters:
+    - engine: The engine of the database to upgrade.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index_exists(engine, table.name, index.name):
+                continue
+            try:
+                index.create(bind=engine)
+            except IntegrityError:
+                # Rows from before the constraint break it; the app still works without the index
+                logger.warning("Could not create unique index %s, %s holds duplicate rows",
+                               index.name, table.name)
+
+
+def index_exists(engine: Engine, table_name: str, index_name: str) -> bool:
+    """
+    Whether an index exists, expression indexes included.
+
+    SQLite's reflection skips indexes on expressions, so there sqlite_master is read instead.
+    """
+    if engine.dialect.name != "sqlite":
+        return inspect(engine).has_index(table_name, index_name)
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"),
+                            {"name": index_name}).first() is not None
+
+
+def backfill_sent_at(engine: Engine, batch_size: int = SENT_AT_BACKFILL_BATCH_SIZE) -> int:
+    """
+    Fill in the sent_at column of messages from their created_at text.
+
+    Messages are read in id order from the partial index of the rows still
+    missing a sent_at, and updated by primary key one batch per transaction,
+    so the upgrade can be interrupted and resumed. Rows whose text can not be
+    parsed are left empty.
+
+    Parameters:
+    - engine: The engine of the database to upgrade.
+    - batch_size: Number of messages per transaction.
+
+    Returns:
+    - int: The number of messages filled in.
+    """
+    filled, after_id = 0, 0
+    with Session(engine) as db:
+        while True:
+            rows = (db.query(models.ChatMessage.id, models.ChatMessage.created_at)
+                    .filter(models.ChatMessage.sent_at.is_(None), models.ChatMessage.id > after_id)
+                    .order_by(models.ChatMessage.id).limit(batch_size).all())
+            if not rows:
+                return filled
+            after_id = rows[-1].id
+            values = [{"id": row.id, "sent_at": parse_timestamp(row.created_at)} for row in rows]
+            values = [value for value in values if value["sent_at"] is not None]
+            if values:
+                db.execute(update(models.ChatMessage), values)
+                db.commit()
+                filled += len(values)
+
+
+def backfill_chat_summaries(engine: Engine, batch_size: int = BACKFILL_BATCH_SIZE):
+    """
+    Create the summary of every chat that has none, from its existing messages.
+
+    The existing history counts as read by both participants. Chats are
+    processed in batches, each with one aggregate query over the
+    (chat_id, id) index and one query for the last messages.
+
+    Parameters:
+    - engine: The engine of the database to upgrade.
+    - batch_size: Number of chats per transaction.
+    """
+    with Session(engine) as db:
+        chats = (db.query(models.Chat)
+                 .outerjoin(models.ChatSummary, models.ChatSummary.chat_id == models.Chat.id)
+                 .filter(models.ChatSummary.chat_id.is_(None))
+                 .order_by(models.Chat.id).all())
+        for start in range(0, len(chats), batch_size):
+            batch = chats[start:start + batch_size]
+            stats = {chat_id: (last_id, count) for chat_id, last_id, count in
+                     db.query(models.ChatMessage.chat_id, func.max(models.ChatMessage.id),
+                              func.count(models.ChatMessage.id))
+                     .filter(models.ChatMessage.chat_id.in_([chat.id for chat in batch]))
+                     .group_by(models.ChatMessage.chat_id)}
+            last_messages = {message.id: message for message in db.query(models.ChatMessage).filter(
+                models.ChatMessage.id.in_([last_id for last_id, _ in stats.values()]))}
+            for chat in batch:
+                last_id, count = stats.get(chat.id, (None, 0))
+                last = last_messages.get(last_id)
+                db.add(models.ChatSummary(
+                    chat_id=chat.id, last_message_id=last_id, message_count=count,
+                    last_sender_id=last.sender_id if last else None,
+                    snippet=last.message[:config.CHAT_SNIPPET_LENGTH] if last and last.message else None,
+                    last_created_at=last.created_at if last else None))
+                for user_id in {chat.user_id, chat.friend_id} - {None}:
+                    db.merge(models.ChatReadState(chat_id=chat.id, user_id=user_id,
+                                                  last_read_id=last_id or 0, unread_count=0))
+            db.commit()
+
+
+def upgrade(engine: Engine):
+    """
+    Bring the database up to date with the models.
+
+    Parameters:
+    - engine: The engine of the database to upgrade.
+    """
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    create_missing_indexes(engine)
+    backfill_sent_at(engine)
+    backfill_chat_summaries(engine)
+    fts.create(engine)
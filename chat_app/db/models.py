@@ -1,7 +1,14 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, DateTime, Float, Index, Integer, String, ForeignKey, case, text
 from sqlalchemy.orm import relationship
 from .base import Base
 
+
+def ordered_pair(first, second):
+    """
+    The lower and the higher of two user id expressions, so that (a, b) and (b, a) compare equal.
+    """
+    return case((first < second, first), else_=second), case((first < second, second), else_=first)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -13,8 +20,8 @@ class Friend(Base):
     __tablename__ = "friends"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    friend_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    friend_id = Column(Integer, ForeignKey("users.id"), index=True)
 
     user = relationship("User", foreign_keys=[user_id])
     friend = relationship("User", foreign_keys=[friend_id])
@@ -23,10 +30,15 @@ class Chat(Base):
     __tablename__ = "chats"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    friend_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    friend_id = Column(Integer, ForeignKey("users.id"), index=True)
     messages = relationship("ChatMessage", back_populates="chat")
 
+    __table_args__ = (
+        # One chat per pair of users, whichever of the two started it
+        Index("ux_chats_user_pair", *ordered_pair(user_id, friend_id), unique=True),
+    )
+
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
 
@@ -35,4 +47,49 @@ class ChatMessage(Base):
     sender_id = Column(Integer, ForeignKey("users.id"))
     message = Column(String)
     created_at =  Column(String)
+    sent_at = Column(DateTime)
     chat = relationship("Chat", back_populates="messages")
+
+    __table_args__ = (
+        # Serves the keyset pagination of a chat's history
+        Index("ix_chat_messages_chat_id_id", "chat_id", "id"),
+        # Serves the time range queries of a chat's history
+        Index("ix_chat_messages_chat_id_sent_at", "chat_id", "sent_at"),
+        # Finds the rows the sent_at backfill has yet to fill in; stays empty afterwards
+        Index("ix_chat_messages_sent_at_missing", "id", sqlite_where=text("sent_at IS NULL"),
+              postgresql_where=text("sent_at IS NULL")),
+    )
+
+# Denormalized state of a chat, kept up to date as messages are inserted so
+# that listing chats never scans their history.
+class ChatSummary(Base):
+    __tablename__ = "chat_summaries"
+
+    chat_id = Column(Integer, ForeignKey("chats.id"), primary_key=True)
+    last_message_id = Column(Integer)
+    last_sender_id = Column(Integer, ForeignKey("users.id"))
+    snippet = Column(String)
+    last_created_at = Column(String)
+    message_count = Column(Integer, default=0, nullable=False)
+
+# Read cursor of a participant in a chat, with the number of messages after it.
+class ChatReadState(Base):
+    __tablename__ = "chat_read_states"
+
+    chat_id = Column(Integer, ForeignKey("chats.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True, index=True)
+    last_read_id = Column(Integer, default=0, nullable=False)
+    unread_count = Column(Integer, default=0, nullable=False)
+
+class RewriteCacheEntry(Base):
+    __tablename__ = "rewrite_cache"
+
+    key = Column(String, primary_key=True)
+    value = Column(String)
+    expires_at = Column(Float, index=True)
+
+class RevokedSession(Base):
+    __tablename__ = "revoked_sessions"
+
+    session_id = Column(String, primary_key=True)
+    expires_at = Column(Float, index=True)
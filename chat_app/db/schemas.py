@@ -1,4 +1,5 @@
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 from pydantic import BaseModel
 
 class OurBaseModel(BaseModel):
@@ -18,7 +19,7 @@ class UserLogin(UserBase):
     password: str
 
 class RegisterValidator(UserBase):
-    pass
+    password: str
 
 class UserUpdate(UserBase):
     pass
@@ -36,6 +37,7 @@ class FriendCreate(FriendBase):
     pass
 
 class Friend(FriendBase):
+    id: int
     friend_id: int
 
     class Config:
@@ -69,12 +71,35 @@ class ChatCreate(ChatBase):
 class Chat(ChatBase):
     id: int
 
+class ChatReadState(OurBaseModel):
+    chat_id: int
+    user_id: int
+    last_read_id: int
+    unread_count: int
+
+class ChatOverview(Chat):
+    last_message_id: Optional[int]
+    last_sender_id: Optional[int]
+    snippet: Optional[str]
+    last_created_at: Optional[str]
+    message_count: int = 0
+    last_read_id: int = 0
+    unread_count: int = 0
+
 class ChatMessage(OurBaseModel):
     sender_id: int
     message: str
     chat_id: int
     created_at: str
 
+class ChatMessageRead(ChatMessage):
+    id: int
+    sent_at: Optional[datetime]
+
+class MessageSearchResult(ChatMessageRead):
+    snippet: str
+    rank: float
+
 class MessageCreate(ChatMessage):
     pass
 
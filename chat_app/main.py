@@ -4,16 +4,31 @@ Main Application for chat app
 import os
 script_dir = os.path.dirname(__file__)
 st_abs_file_path = os.path.join(script_dir, "static/")
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from chat_app.api import chats, messages
 from chat_app.api import users, ui, auth
-from chat_app.db.base import Base, engine
+from chat_app.api import metrics as metrics_api
+from chat_app import config, metrics, profiling
+from chat_app.db.base import async_engine, engine, profile_queries
+from chat_app.db import migrations
+from chat_app.db.cache import membership
 import uvicorn
-Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
 app = FastAPI(debug=True)
 app.mount("/static", StaticFiles(directory=st_abs_file_path), name="static")
+if config.METRICS_ENABLED:
+    # Before the ui router, whose /{chat_id} would match /metrics
+    app.include_router(metrics_api.router)
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.instrument_engine(engine, "sync")
+    metrics.instrument_engine(async_engine.sync_engine, "async")
+if config.QUERY_PROFILING:
+    app.add_middleware(profiling.QueryProfilerMiddleware, summary_header=app.debug)
+    profile_queries(engine)
+    profile_queries(async_engine.sync_engine)
 app.include_router(ui.router)
 app.include_router(users.router)
 app.include_router(auth.router)
@@ -21,6 +36,35 @@ app.include_router(chats.router)
 app.include_router(messages.router)
 
 from chat_app.api.websocketchat import *
+from chat_app.persistence import writer
+from chat_app.ws import manager
+from chat_app.sessions import sessions
+from chat_app.utils import HasherBusy
+
+
+@app.exception_handler(HasherBusy)
+async def hasher_busy_handler(request: Request, exc: HasherBusy) -> JSONResponse:
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+
+@app.on_event("startup")
+async def start_background_services():
+    writer.start()
+    await manager.start()
+    await sessions.start()
+    # Friendships and chats are loaded once, then kept up to date by crud
+    await membership.load()
+    manager.share_membership()
+
+
+@app.on_event("shutdown")
+async def stop_background_services():
+    # Save the messages still buffered before the process exits
+    await writer.stop()
+    await manager.stop()
+    await sessions.stop()
+    metrics.mark_process_dead()
+
 origins = [
     "http://localhost",
     "http://localhost:8080",
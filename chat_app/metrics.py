@@ -0,0 +1,139 @@
+"""
+Prometheus metrics of the app, served at /metrics.
+
+With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty
+directory shared by the workers before they start: every process then writes
+its samples there and /metrics aggregates them, whichever worker answers.
+"""
+import os
+import time
+from typing import Dict
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# Buckets in seconds, from sub-millisecond in-memory work to slow HTTP calls
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SLOW_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_SECONDS = Histogram("chat_http_request_duration_seconds", "Time to answer an HTTP request.",
+                            ["method", "route", "status"], buckets=SLOW_BUCKETS)
+
+WEBSOCKET_CONNECTIONS = Gauge("chat_websocket_connections", "Open websocket connections.",
+                              multiprocess_mode="livesum")
+WEBSOCKET_ACCEPT_SECONDS = Histogram("chat_websocket_accept_seconds",
+                                     "Time from a websocket handshake to its accept, admission included.",
+                                     buckets=SLOW_BUCKETS)
+WEBSOCKET_REJECTED = Counter("chat_websocket_rejected_total", "Websocket connections turned away.", ["reason"])
+WEBSOCKET_EVICTED = Counter("chat_websocket_evicted_total", "Websocket connections dropped for lagging behind.",
+                            ["reason"])
+FANOUT_RECIPIENTS = Histogram("chat_broadcast_recipients", "Local connections an event is delivered to.",
+                              buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000))
+FANOUT_SECONDS = Histogram("chat_broadcast_fanout_seconds", "Time to queue an event on its local recipients.",
+                           buckets=FAST_BUCKETS)
+
+AI_REWRITE_SECONDS = Histogram("chat_ai_rewrite_duration_seconds", "Time to rewrite a message, by outcome.",
+                               ["outcome"], buckets=SLOW_BUCKETS)
+
+PERSISTENCE_BATCH_SECONDS = Histogram("chat_persistence_batch_seconds",
+                                      "Time to save (asyncio) or enqueue (celery) a batch of messages.",
+                                      ["mode"], buckets=SLOW_BUCKETS)
+PERSISTED_MESSAGES = Counter("chat_persisted_messages_total", "Messages saved or handed to Celery.", ["mode"])
+PERSISTENCE_FAILED_MESSAGES = Counter("chat_persistence_failed_messages_total",
+                                      "Messages given up on after every write attempt failed.", ["mode"])
+CELERY_ENQUEUE_SECONDS = Histogram("chat_celery_enqueue_seconds", "Time to publish a task to the broker.",
+                                   ["task"], buckets=FAST_BUCKETS + SLOW_BUCKETS[-4:])
+
+DB_QUERY_SECONDS = Histogram("chat_db_query_duration_seconds", "Time to execute a SQL statement.",
+                             ["engine", "operation"], buckets=FAST_BUCKETS)
+DB_CONNECTIONS_IN_USE = Gauge("chat_db_pool_connections_in_use", "Connections checked out of the pool.",
+                              ["engine"], multiprocess_mode="livesum")
+
+_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"}
+
+
+def instrument_engine(engine: Engine, name: str):
+    """
+    Time every statement run on an engine and track its checked out connections.
+
+    Parameters:
+    - engine: A sync engine; for an async engine pass its sync_engine.
+    - name: The "engine" label of the metrics.
+    """
+    in_use = DB_CONNECTIONS_IN_USE.labels(name)
+    histograms: Dict[str, Histogram] = {operation: DB_QUERY_SECONDS.labels(name, operation.lower())
+                                        for operation in _OPERATIONS | {"OTHER"}}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def observe(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        if started is None:
+            return
+        operation = statement[:6].upper()
+        histograms[operation if operation in _OPERATIONS else "OTHER"].observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "checkout")
+    def checked_out(dbapi_connection, connection_record, connection_proxy):
+        in_use.inc()
+
+    @event.listens_for(engine, "checkin")
+    def checked_in(dbapi_connection, connection_record):
+        in_use.dec()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing HTTP requests, labelled by route template rather
+    than by path, so that /api/chats/1 and /api/chats/2 share a series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router puts the matched route on the scope, and mounts (static
+            # files) their prefix as root_path; unmatched paths share one label
+            route = scope.get("route")
+            label = route.path if route is not None else scope.get("root_path") or "unmatched"
+            REQUEST_SECONDS.labels(scope["method"], label, str(status)).observe(time.perf_counter() - started)
+
+
+def render() -> bytes:
+    """
+    The metrics of this process, or of every worker in multiprocess mode, in the text format.
+    """
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def mark_process_dead():
+    """
+    Drop the live gauges of this worker from the multiprocess files on shutdown.
+    """
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
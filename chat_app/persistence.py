@@ -0,0 +1,173 @@
+"""
+Write-behind persistence of chat messages.
+
+Messages are queued by the websocket handler and written in batches, with
+one multi-row insert per batch, instead of one transaction (and one broker
+round trip) per message.
+
+Clients are told a message was sent as soon as it is queued. A batch that
+can not be written is retried with a growing delay, and if it still fails
+its senders get a failure through the on_failure callback.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional
+from chat_app import config, metrics
+from chat_app.db import crud
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Buffers messages and flushes them in batches, on a size or a time threshold.
+
+    A single flusher task writes the batches one after the other in arrival
+    order, which keeps the messages of every chat in order.
+
+    Parameters:
+    - mode: "asyncio" to insert the batches from this process, "celery" to
+      hand them to the send_messages task.
+    - batch_size: Number of pending messages that triggers a flush.
+    - flush_interval: Longest time in seconds a message waits before being flushed.
+    - max_pending: Bound of the buffer; submitting waits while it is full.
+    - attempts: Attempts at writing a batch before giving up on it.
+    - retry_delay: Delay in seconds before the first retry, doubled for each of the next ones.
+    """
+
+    def __init__(self, mode: str = config.PERSISTENCE_MODE,
+                 batch_size: int = config.PERSISTENCE_BATCH_SIZE,
+                 flush_interval: float = config.PERSISTENCE_FLUSH_INTERVAL,
+                 max_pending: int = config.PERSISTENCE_MAX_PENDING,
+                 attempts: int = config.PERSISTENCE_WRITE_ATTEMPTS,
+                 retry_delay: float = config.PERSISTENCE_RETRY_DELAY):
+        if mode not in ("asyncio", "celery"):
+            raise ValueError(f"Unknown persistence mode: {mode}")
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        # Called with the messages of a batch that could not be saved
+        self.on_failure: Optional[Callable[[List[dict]], Awaitable[None]]] = None
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """
+        Start the flusher task on the running event loop.
+        """
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, message: dict):
+        """
+        Queue a message to be saved.
+
+        Parameters:
+        - message: The message, with sender_id, chat_id, message and created_at.
+        """
+        if self._task is None:
+            self.start()
+        await self._queue.put(message)
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        """
+        Write everything queued so far and wait until it is saved.
+
+        In celery mode this only waits until the batches are handed to the
+        broker: the worker may save them later, and there is no result
+        backend to wait on. Readers right after a flush, like the catch-up of
+        reconnecting websockets, can then miss the latest messages.
+        """
+        if self._task is None:
+            return
+        self._wakeup.set()
+        await self._queue.join()
+
+    async def stop(self):
+        """
+        Flush the pending messages and stop the flusher task.
+        """
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() + 1 < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._write_with_retries(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write_with_retries(self, batch: List[dict]):
+        # Later batches wait meanwhile, which keeps every chat in order
+        delay = self.retry_delay
+        for attempt in range(1, self.attempts + 1):
+            try:
+                await self._write(batch)
+                return
+            except Exception:
+                if attempt == self.attempts:
+                    logger.exception("Failed to save a batch of %s messages, giving up", len(batch))
+                    break
+                logger.warning("Failed to save a batch of %s messages (attempt %s of %s), retrying in %ss",
+                               len(batch), attempt, self.attempts, delay, exc_info=True)
+                await asyncio.sleep(delay)
+                delay *= 2
+        self.failed += len(batch)
+        metrics.PERSISTENCE_FAILED_MESSAGES.labels(self.mode).inc(len(batch))
+        if self.on_failure is not None:
+            try:
+                await self.on_failure(batch)
+            except Exception:
+                logger.exception("Failed to report %s unsaved messages", len(batch))
+
+    async def _write(self, batch: List[dict]):
+        started = time.perf_counter()
+        if self.mode == "celery":
+            from chat_app.tasks import send_messages
+            await asyncio.to_thread(self._enqueue, send_messages, batch)
+        else:
+            await asyncio.to_thread(crud.create_messages, batch)
+        metrics.PERSISTENCE_BATCH_SECONDS.labels(self.mode).observe(time.perf_counter() - started)
+        metrics.PERSISTED_MESSAGES.labels(self.mode).inc(len(batch))
+        self.batches += 1
+        self.written += len(batch)
+
+    @staticmethod
+    def _enqueue(task, batch: List[dict]):
+        # Timed in the worker thread, so that waiting for a thread is not counted
+        started = time.perf_counter()
+        task.delay(messages=batch)
+        metrics.CELERY_ENQUEUE_SECONDS.labels(task.name).observe(time.perf_counter() - started)
+
+
+writer = MessageWriter()
@@ -0,0 +1,84 @@
+"""
+Per-request SQL profiling, turned on with CHAT_APP_QUERY_PROFILING=1.
+
+Every statement run while a request is handled is recorded by the listeners
+of db.base.profile_queries. Once the request is done, statements repeated
+QUERY_REPEAT_THRESHOLD times or more are logged with their call sites, which
+is how loops issuing one query per item show up. In debug mode each response
+also carries the number of statements and their total time, as an
+"X-Query-Profile" header and a "db" Server-Timing entry for the browser's
+developer tools.
+"""
+import json
+import logging
+import time
+from chat_app import config
+from chat_app.db.base import QueryProfile, current_profile
+
+logger = logging.getLogger(__name__)
+
+
+class QueryProfilerMiddleware:
+    """
+    ASGI middleware making a QueryProfile the current one for each HTTP request.
+
+    Parameters:
+    - app: The ASGI app to wrap.
+    - summary_header: Add the summary headers to the responses.
+    - repeat_threshold: Executions of one statement in a request that get it logged.
+    """
+
+    def __init__(self, app, summary_header: bool = False,
+                 repeat_threshold: int = config.QUERY_REPEAT_THRESHOLD):
+        self.app = app
+        self.summary_header = summary_header
+        self.repeat_threshold = repeat_threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        profile = QueryProfile()
+        token = current_profile.set(profile)
+        started = time.perf_counter()
+
+        async def send_with_summary(message):
+            if message["type"] == "http.response.start" and self.summary_header:
+                # Statements run while a streaming response is sent are only in the log
+                repeated = profile.repeated(self.repeat_threshold)
+                headers = list(message.get("headers", []))
+                headers.append((b"x-query-profile", (f"queries={profile.count}, "
+                                                     f"time_ms={profile.seconds * 1000:.2f}, "
+                                                     f"repeated={len(repeated)}").encode()))
+                headers.append((b"server-timing",
+                                f'db;dur={profile.seconds * 1000:.2f};desc="{profile.count} queries"'.encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_summary)
+        finally:
+            current_profile.reset(token)
+            self.report(scope, profile, time.perf_counter() - started)
+
+    def report(self, scope, profile: QueryProfile, seconds: float):
+        route = scope.get("route")
+        summary = {
+            "method": scope["method"],
+            "path": scope["path"],
+            "route": route.path if route is not None else None,
+            "duration_ms": round(seconds * 1000, 2),
+            "queries": profile.count,
+            "query_time_ms": round(profile.seconds * 1000, 2),
+        }
+        repeated = profile.repeated(self.repeat_threshold)
+        if repeated:
+            logger.warning(json.dumps(dict(summary, event="repeated_queries", repeated=[
+                {"statement": " ".join(statement.split()),
+                 "count": len(queries),
+                 "time_ms": round(sum(query.seconds for query in queries) * 1000, 2),
+                 "call_sites": sorted({query.call_site for query in queries})}
+                for statement, queries in sorted(repeated.items(), key=lambda item: -len(item[1]))
+            ])))
+        elif profile.count:
+            logger.debug(json.dumps(dict(summary, event="request_queries")))
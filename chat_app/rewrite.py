@@ -0,0 +1,372 @@
+"""
+Asynchronous AI rewrite pipeline for messages sent over the websocket.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import openai
+from chat_app import config, metrics
+from chat_app.db import crud
+from chat_app.db.base import SessionLocal
+from chat_app.utils import rewrite_prompt
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionBackend:
+    """
+    Something that can rewrite a message in a given tone.
+    """
+
+    async def rewrite(self, message: str, tone: str) -> str:
+        raise NotImplementedError
+
+    async def rewrite_batch(self, items: Sequence[Tuple[str, str]]) -> List[Optional[str]]:
+        """
+        Rewrite several (message, tone) pairs at once.
+
+        Backends that can not batch natively rewrite the items concurrently;
+        an item whose rewrite failed comes back as None.
+        """
+        results = await asyncio.gather(*(self.rewrite(message, tone) for message, tone in items),
+                                       return_exceptions=True)
+        return [None if isinstance(result, BaseException) else result for result in results]
+
+
+class OpenAIBackend(CompletionBackend):
+    """
+    Rewrites messages with the OpenAI completion API, without blocking the event loop.
+    """
+
+    def __init__(self, engine: str = "text-davinci-002", options: Optional[dict] = None):
+        self.engine = engine
+        self.options = dict(config.OPENAI_CONFIG if options is None else options)
+
+    async def rewrite(self, message: str, tone: str) -> str:
+        response = await openai.Completion.acreate(
+            engine=self.engine,
+            prompt=rewrite_prompt(message, tone),
+            **self.options
+        )
+        return response.choices[0].text
+
+    async def rewrite_batch(self, items: Sequence[Tuple[str, str]]) -> List[Optional[str]]:
+        # The completion API takes a list of prompts and answers each of them
+        # with a choice carrying the index of its prompt.
+        response = await openai.Completion.acreate(
+            engine=self.engine,
+            prompt=[rewrite_prompt(message, tone) for message, tone in items],
+            **self.options
+        )
+        results: List[Optional[str]] = [None] * len(items)
+        for choice in response.choices:
+            results[choice.index] = choice.text
+        return results
+
+
+class FakeBackend(CompletionBackend):
+    """
+    Local stand-in for the completion API, for development, tests and benchmarks.
+
+    Parameters:
+    - latency: Seconds to sleep before answering, to mimic the network round trip.
+    - transform: Function applied to (message, tone); returns the message unchanged by default.
+    """
+
+    def __init__(self, latency: float = 0.0,
+                 transform: Optional[Callable[[str, str], str]] = None):
+        self.latency = latency
+        self.transform = transform or (lambda message, tone: message)
+        self.calls = 0
+
+    async def rewrite(self, message: str, tone: str) -> str:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.transform(message, tone)
+
+    async def rewrite_batch(self, items: Sequence[Tuple[str, str]]) -> List[Optional[str]]:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self.transform(message, tone) for message, tone in items]
+
+
+class BatchingBackend(CompletionBackend):
+    """
+    Collects concurrent rewrites into micro-batches sent with a single backend call.
+
+    A batch is sent once ``max_batch`` rewrites are pending, or ``window``
+    seconds after the first of them arrived, whichever comes first. Every
+    caller gets its own result; an item the backend could not rewrite raises
+    for that caller only. At most ``max_concurrency`` batches are in flight.
+    """
+
+    def __init__(self, backend: CompletionBackend,
+                 window: float = config.AI_REWRITE_BATCH_WINDOW,
+                 max_batch: int = config.AI_REWRITE_BATCH_SIZE,
+                 max_concurrency: int = config.AI_REWRITE_CONCURRENCY):
+        self.backend = backend
+        self.window = window
+        self.max_batch = max_batch
+        self.max_concurrency = max_concurrency
+        self.batches = 0
+        self._pending: List[Tuple[str, str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def rewrite(self, message: str, tone: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message, tone, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self.batches += 1
+            asyncio.create_task(self._send(batch))
+
+    async def _send(self, batch: List[Tuple[str, str, asyncio.Future]]):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        try:
+            async with self._semaphore:
+                results = await self.backend.rewrite_batch([(message, tone) for message, tone, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (message, tone, future), result in zip(batch, results):
+            if future.done():
+                # The caller timed out and already fell back to its original text.
+                continue
+            if isinstance(result, str):
+                future.set_result(result)
+            elif isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_exception(RuntimeError("No rewrite returned for message"))
+
+
+class CacheStore:
+    """
+    Shared storage for rewrite cache entries, reused by every app worker.
+    """
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: float):
+        raise NotImplementedError
+
+
+class DatabaseCacheStore(CacheStore):
+    """
+    Keeps rewrite cache entries in the ``rewrite_cache`` table of the app database.
+
+    Expired rows are deleted while setting an entry, at most once every
+    sweep_interval seconds, so the table does not grow without bound.
+    """
+
+    def __init__(self, sweep_interval: float = config.AI_REWRITE_CACHE_SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0.0
+
+    def get(self, key: str) -> Optional[str]:
+        db = SessionLocal()
+        try:
+            entry = crud.get_rewrite_cache_entry(db, key=key, now=time.time())
+            return entry.value if entry is not None else None
+        finally:
+            db.close()
+
+    def set(self, key: str, value: str, ttl: float):
+        db = SessionLocal()
+        try:
+            now = time.time()
+            crud.set_rewrite_cache_entry(db, key=key, value=value, expires_at=now + ttl)
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                crud.delete_expired_rewrite_cache_entries(db, now=now)
+        finally:
+            db.close()
+
+
+class RewriteCache:
+    """
+    Bounded LRU cache of rewrites with a time to live, optionally backed by a shared store.
+
+    Entries are keyed on the tone, the normalized message text and the model
+    parameters, so a change to OPENAI_CONFIG never serves stale rewrites.
+    """
+
+    def __init__(self, max_size: int = config.AI_REWRITE_CACHE_SIZE,
+                 ttl: float = config.AI_REWRITE_CACHE_TTL,
+                 max_length: int = config.AI_REWRITE_CACHE_MAX_LENGTH,
+                 params: Optional[dict] = None,
+                 store: Optional[CacheStore] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_length = max_length
+        self.params = sorted((config.OPENAI_CONFIG if params is None else params).items())
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    @staticmethod
+    def normalize(message: str) -> str:
+        return " ".join(message.split()).casefold()
+
+    def key(self, message: str, tone: str) -> Optional[str]:
+        """
+        Build the cache key of a message, or None if it is too long to be worth caching.
+        """
+        normalized = self.normalize(message)
+        if not normalized or len(normalized) > self.max_length:
+            return None
+        raw = json.dumps([tone, normalized, self.params], separators=(",", ":"))
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        if self.store is not None:
+            value = await asyncio.to_thread(self._store_call, self.store.get, key)
+            if value is not None:
+                self._put(key, value)
+                self.hits += 1
+                self.shared_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str):
+        self._put(key, value)
+        if self.store is not None:
+            await asyncio.to_thread(self._store_call, self.store.set, key, value, self.ttl)
+
+    def _put(self, key: str, value: str):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _store_call(method, *args):
+        try:
+            return method(*args)
+        except Exception:
+            logger.exception("Shared rewrite cache unavailable")
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits,
+                "misses": self.misses, "shared_hits": self.shared_hits}
+
+    def clear(self):
+        self._entries.clear()
+
+
+class MessageRewriter:
+    """
+    Runs AI rewrites with a bounded concurrency and a timeout.
+
+    Whenever the backend is slow, busy or failing, the original message is
+    returned so that sending a message never waits longer than the timeout.
+    """
+
+    def __init__(self, backend: CompletionBackend,
+                 timeout: float = config.AI_REWRITE_TIMEOUT,
+                 max_concurrency: Optional[int] = config.AI_REWRITE_CONCURRENCY,
+                 enabled: bool = config.AI_ENABLED,
+                 cache: Optional[RewriteCache] = None):
+        self.backend = backend
+        self.cache = cache
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.enabled = enabled
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def rewrite(self, message: str, tone: str = config.tone) -> str:
+        """
+        Rewrite a message in the given tone.
+
+        Parameters:
+        - message: The message to be rewritten.
+        - tone: The desired tone for the rewritten message.
+
+        Returns:
+        - str: The rewritten message, or the original one if the rewrite failed or timed out.
+        """
+        if not self.enabled:
+            return message
+        started = time.perf_counter()
+        key = self.cache.key(message, tone) if self.cache is not None else None
+        if key is not None:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                metrics.AI_REWRITE_SECONDS.labels("cached").observe(time.perf_counter() - started)
+                return cached
+        try:
+            rewritten = await asyncio.wait_for(self._rewrite(message, tone), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("AI rewrite timed out after %ss, sending original message", self.timeout)
+            metrics.AI_REWRITE_SECONDS.labels("timeout").observe(time.perf_counter() - started)
+            return message
+        except Exception:
+            logger.exception("AI rewrite failed, sending original message")
+            metrics.AI_REWRITE_SECONDS.labels("error").observe(time.perf_counter() - started)
+            return message
+        rewritten = rewritten.strip()
+        if not rewritten:
+            metrics.AI_REWRITE_SECONDS.labels("empty").observe(time.perf_counter() - started)
+            return message
+        metrics.AI_REWRITE_SECONDS.labels("ok").observe(time.perf_counter() - started)
+        if key is not None:
+            await self.cache.set(key, rewritten)
+        return rewritten
+
+    async def _rewrite(self, message: str, tone: str) -> str:
+        if self.max_concurrency is None:
+            return await self.backend.rewrite(message, tone)
+        if self._semaphore is None:
+            # Created lazily so that it belongs to the running event loop.
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await self.backend.rewrite(message, tone)
+
+
+def make_backend(name: str = config.AI_BACKEND) -> CompletionBackend:
+    """
+    Build the completion backend configured by name ("openai" or "fake").
+    """
+    backends = {"openai": OpenAIBackend, "fake": FakeBackend}
+    if name not in backends:
+        raise ValueError(f"Unknown AI backend: {name}")
+    return backends[name]()
+
+
+cache = RewriteCache(store=DatabaseCacheStore() if config.AI_REWRITE_CACHE_SHARED else None)
+if config.AI_REWRITE_BATCHING:
+    # The batching backend bounds the number of requests in flight itself.
+    rewriter = MessageRewriter(BatchingBackend(make_backend()), max_concurrency=None, cache=cache)
+else:
+    rewriter = MessageRewriter(make_backend(), cache=cache)
@@ -0,0 +1,192 @@
+"""
+Signed, expiring session tokens stored in the "X-Authorization" cookie.
+
+A token carries the user's id and username and is signed with HMAC-SHA256,
+so it is validated without any database lookup. Revoked sessions are kept
+in the database and reloaded by each process every
+SESSION_REVOCATION_REFRESH seconds, by a background task once the app has
+started, so that validating a token never waits on the database.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import threading
+import time
+from typing import NamedTuple, Optional, Set
+from fastapi import HTTPException, Request
+from starlette.requests import HTTPConnection
+from chat_app import config
+from chat_app.db import crud
+from chat_app.db.base import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+COOKIE_NAME = "X-Authorization"
+
+
+class UserSession(NamedTuple):
+    user_id: int
+    username: str
+    session_id: str
+    expires_at: float
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class SessionManager:
+    """
+    Issues, validates and revokes session tokens.
+    """
+
+    def __init__(self, secret_key: str = config.SECRET_KEY, ttl: float = config.SESSION_TTL,
+                 revocation_refresh: float = config.SESSION_REVOCATION_REFRESH):
+        if not secret_key:
+            logger.warning("CHAT_APP_SECRET_KEY is not set, sessions will not survive a restart "
+                           "nor be shared between workers")
+            secret_key = secrets.token_hex(32)
+        self._key = secret_key.encode()
+        self.ttl = ttl
+        self.revocation_refresh = revocation_refresh
+        self._revoked: Set[str] = set()
+        self._recently_revoked: Set[str] = set()
+        self._revoked_loaded_at = float("-inf")
+        self._lock = threading.Lock()
+        self._refresher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """
+        Start reloading the revoked sessions in the background.
+        """
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+
+    def issue(self, user_id: int, username: str) -> str:
+        """
+        Create a signed token for a user.
+
+        Parameters:
+        - user_id: The ID of the user.
+        - username: The username of the user.
+
+        Returns:
+        - str: The token, to be stored in the session cookie.
+        """
+        claims = [user_id, username, secrets.token_hex(16), time.time() + self.ttl]
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        return f"{payload}.{self._sign(payload)}"
+
+    def validate(self, token: Optional[str]) -> Optional[UserSession]:
+        """
+        Check a token's signature, expiry and revocation.
+
+        Parameters:
+        - token: The token from the session cookie.
+
+        Returns:
+        - UserSession: The session, or None if the token is missing, forged, expired or revoked.
+        """
+        if not token or "." not in token:
+            return None
+        payload, _, signature = token.rpartition(".")
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            session = UserSession(*json.loads(_b64decode(payload)))
+        except (ValueError, TypeError):
+            return None
+        if session.expires_at < time.time() or session.session_id in self._revoked_sessions():
+            return None
+        return session
+
+    def revoke(self, token: Optional[str]):
+        """
+        Revoke the session of a token, in every process.
+
+        Parameters:
+        - token: The token from the session cookie.
+        """
+        session = self.validate(token)
+        if session is None:
+            return
+        db = SessionLocal()
+        try:
+            crud.revoke_session(db, session_id=session.session_id, expires_at=session.expires_at)
+        finally:
+            db.close()
+        with self._lock:
+            self._revoked.add(session.session_id)
+            self._recently_revoked.add(session.session_id)
+
+    def from_connection(self, connection: HTTPConnection) -> Optional[UserSession]:
+        """
+        Get the session of a request or websocket from its cookie.
+        """
+        return self.validate(connection.cookies.get(COOKIE_NAME))
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self._key, payload.encode(), hashlib.sha256).digest())
+
+    def reload_revoked(self):
+        """
+        Reload the revoked sessions of every process from the database.
+        """
+        with self._lock:
+            # Sessions revoked before this point are in what is read below
+            self._recently_revoked = set()
+        db = SessionLocal()
+        try:
+            revoked = crud.get_revoked_sessions(db, now=time.time())
+        finally:
+            db.close()
+        with self._lock:
+            self._revoked = revoked | self._recently_revoked
+            self._revoked_loaded_at = time.monotonic()
+
+    def _revoked_sessions(self) -> Set[str]:
+        # Without the background task (scripts, apps not started) the set is reloaded inline
+        if self._refresher is None and time.monotonic() - self._revoked_loaded_at >= self.revocation_refresh:
+            self.reload_revoked()
+        return self._revoked
+
+    async def _refresh_forever(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.reload_revoked)
+            except Exception:
+                logger.exception("Could not reload the revoked sessions")
+            await asyncio.sleep(self.revocation_refresh)
+
+
+sessions = SessionManager()
+
+
+def current_session(request: Request) -> Optional[UserSession]:
+    """
+    Dependency returning the session of the current user, or None if not logged in.
+    """
+    return sessions.from_connection(request)
+
+
+def require_session(request: Request) -> UserSession:
+    """
+    Dependency returning the session of the current user, answering 401 if not logged in.
+    """
+    session = sessions.from_connection(request)
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in")
+    return session
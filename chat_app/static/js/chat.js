@@ -4,26 +4,160 @@ $(document).ready(function(){
         current_user = response;
     });
     var receiver = "";
-    // create websocket
-    var socket = new WebSocket("ws://localhost:8000/ws/chat");
-    socket.onmessage = function(event) {
-
-        var parent = $("#messages");
-        var data = JSON.parse(event.data);
-        if ("db_status" in data && "success" in data["db_status"] && data["db_status"]["success"] == false) {
-            var content = "<div class='error'><span>There was an error processing this message:</span><br/> <i>" + data["db_status"]["message"]+ "</i></div>";
-            parent.append(content);
-            document.getElementById('messages').scrollTop = document.getElementById('messages').scrollHeight;
-            return;
-        }
-        var sender = data['sender'];
+    // Messages are saved shortly after they are broadcast, so the read cursor
+    // is moved a moment after the last one arrived.
+    var read_timer = null;
+    function markRead(){
+        clearTimeout(read_timer);
+        read_timer = setTimeout(function(){
+            $.post("/api/chats/" + $("#chat_id").val() + "/read");
+        }, 1000);
+    }
+    var chat_id = $("#chat_id").val();
+    var socket;
+    var retry_delay = 1000;
+    function scrollDown(){
+        document.getElementById('messages').scrollTop = document.getElementById('messages').scrollHeight;
+    }
+    // Reconnect cursor: the sent_at of the newest message shown, live ones
+    // included (they have no id until saved). ISO timestamps sort as text.
+    function lastSeen(){
+        var newest = "";
+        $("#messages p[data-sent-at]").each(function(){
+            var sent_at = $(this).attr("data-sent-at");
+            if (sent_at > newest)
+                newest = sent_at;
+        });
+        return newest || "0";
+    }
+    function renderMessage(message){
+        var sender = message.sender;
         if (sender == current_user)
             sender = "You";
-        var message = data['message']
-        var content = "<p><strong>"+sender+" </strong> <span> "+message+"</span> </br> <span class='sentdate'>" + data['created_at'] + "</span></p>";
-        parent.append(content);
-        document.getElementById('messages').scrollTop = document.getElementById('messages').scrollHeight;
-    };
+        var p = $("<p>").attr("data-sent-at", message.sent_at)
+            .append($("<strong>").text(sender + " "))
+            .append($("<span>").text(" " + message.message + " "))
+            .append("<br/>")
+            .append($("<span class='sentdate'>").text(message.created_at));
+        if (message.id !== undefined)
+            p.attr("data-id", message.id);
+        else
+            p.addClass("live");
+        return p;
+    }
+    function isShown(message){
+        return message.sent_at && $("#messages p").filter(function(){
+            return $(this).attr("data-sent-at") == message.sent_at;
+        }).length > 0;
+    }
+    // Catch-up after a reconnect: a live message shown without an id gets the
+    // id of its saved copy, the missed ones are appended.
+    function applySync(data){
+        var parent = $("#messages");
+        $.each(data.messages, function(i, message){
+            if (parent.find("p[data-id='" + message.id + "']").length)
+                return;
+            var live = parent.find("p.live").filter(function(){
+                return $(this).attr("data-sent-at") == message.sent_at;
+            });
+            if (live.length)
+                live.first().attr("data-id", message.id).removeClass("live");
+            else
+                parent.append(renderMessage(message));
+        });
+        if (data.done && data.truncated)
+            window.location.reload();
+        scrollDown();
+    }
+    function renderPresence(users, message, created_at){
+        $.each(users, function(i, sender){
+            if (sender == current_user)
+                sender = "You";
+            $("#messages").append($("<p>")
+                .append($("<strong>").text(sender + " "))
+                .append($("<span>").text(" " + message))
+                .append("<br/>")
+                .append($("<span class='sentdate'>").text(created_at)));
+        });
+    }
+    function connect(resume){
+        var url = "ws://localhost:8000/ws/chat?chat_id=" + chat_id;
+        if (resume)
+            url += "&last_seen=" + encodeURIComponent(chat_id + ":" + lastSeen());
+        socket = new WebSocket(url);
+        socket.onopen = function(){
+            retry_delay = 1000;
+        };
+        socket.onclose = function(event){
+            // 1008: not logged in or too many tabs open, retrying will not help
+            if (event.code == 1008)
+                return;
+            // Reconnect with a randomized backoff, so that clients dropped
+            // together do not all come back at the same moment, asking only
+            // for what was missed
+            setTimeout(function(){ connect(true); }, retry_delay * (0.5 + Math.random()));
+            retry_delay = Math.min(retry_delay * 2, 30000);
+        };
+        socket.onmessage = function(event) {
+            var parent = $("#messages");
+            var data = JSON.parse(event.data);
+            if (data.type == "sync") {
+                applySync(data);
+                return;
+            }
+            if (data.type == "presence") {
+                renderPresence(data.joined, "got connected", data.created_at);
+                renderPresence(data.left, "left", data.created_at);
+                scrollDown();
+                return;
+            }
+            if ("db_status" in data && "success" in data["db_status"] && data["db_status"]["success"] == false) {
+                // Failures are sent to all the sender's connections, whatever chat they show
+                if ("chat_id" in data && data.chat_id != $("#chat_id").val())
+                    return;
+                parent.append($("<div class='error'>")
+                    .append($("<span>").text("There was an error processing this message:"))
+                    .append("<br/> ")
+                    .append($("<i>").text(data["db_status"]["message"])));
+                scrollDown();
+                return;
+            }
+            if ("db_status" in data) {
+                // Already shown by the catch-up that ran when reconnecting
+                if (isShown(data))
+                    return;
+                if (data.sender != current_user)
+                    markRead();
+                parent.append(renderMessage(data));
+            }
+            scrollDown();
+        };
+    }
+    connect(false);
+    // Fetch the page of history before the oldest message shown
+    $("#messages").on("click", "#load-older", function(){
+        var button = $(this);
+        var oldest = $("#messages p[data-id]").first().data("id");
+        var page_size = parseInt($("#page_size").val());
+        var url = "/api/chats/" + $("#chat_id").val() + "/messages?limit=" + page_size;
+        if (oldest !== undefined)
+            url += "&before_id=" + oldest;
+        $.get(url, function(messages){
+            var older = $.map(messages, function(message){
+                var sender = usernames[message.sender_id];
+                if (sender == current_user)
+                    sender = "You";
+                return $("<p>").attr("data-id", message.id)
+                    .append($("<strong>").text(sender + " "))
+                    .append($("<span>").text(" " + message.message + " "))
+                    .append("<br/>")
+                    .append($("<span class='sentdate'>").text(message.created_at));
+            });
+            button.after(older);
+            if (messages.length < page_size)
+                button.remove();
+        });
+    });
     $("#chat-form").on("submit", function(e){
         e.preventDefault();
         var message = $("#message").val();
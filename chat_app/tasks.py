@@ -1,10 +1,15 @@
 import sys
+from typing import List
 sys.path.append("..")  # Adds higher directory to python modules path.
 from celery import Celery
+from chat_app import config
 from chat_app.db import schemas
 from chat_app.db import crud
 
-celery = Celery('chat_app', broker='amqp://guest@broker//', include=["chat_app.tasks"])
+celery = Celery('chat_app', broker=config.BROKER_URL, include=["chat_app.tasks"])
+# Batches are written by a worker consuming the persistence queue with a concurrency
+# of one, so that batches are saved in the order they were sent.
+celery.conf.task_routes = {"chat_app.tasks.send_messages": {"queue": "persistence"}}
 
 @celery.task
 def send_message(message: schemas.MessageCreate) -> None:
@@ -18,3 +23,16 @@ def send_message(message: schemas.MessageCreate) -> None:
         None
     """
     crud.create_message(message=message)
+
+@celery.task
+def send_messages(messages: List[dict]) -> int:
+    """
+    Celery task for saving a batch of messages in a single transaction.
+
+    Parameters:
+        - messages: The messages to be saved, in the order they were sent.
+
+    Returns:
+        int: The number of messages saved.
+    """
+    return crud.create_messages(messages)
@@ -1,11 +1,78 @@
+import asyncio
+import datetime
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple
 from passlib.context import CryptContext
 import openai
 from .config import OPENAI_CONFIG
 from .config import OPENAI_API_KEY
+from .config import BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING
+from .config import TIMESTAMP_FORMAT
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def make_crypt_context(rounds: int = BCRYPT_ROUNDS) -> CryptContext:
+    """
+    Builds the password hashing policy for a bcrypt cost factor.
+
+    Hashes made with any other cost are reported as needing an update.
+
+    Parameters:
+        rounds: The bcrypt cost factor (log2 of the number of rounds).
+
+    Returns:
+        CryptContext: The hashing policy.
+    """
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=rounds,
+                        bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds)
+
+pwd_context = make_crypt_context()
 openai.api_key = OPENAI_API_KEY
 
+
+class HasherBusy(Exception):
+    """
+    Raised when too many password hashes are already waiting to be computed.
+    """
+
+
+class PasswordHasher:
+    """
+    Computes bcrypt hashes on a dedicated, size-limited thread pool.
+
+    Hashing is CPU bound, so it never runs on the event loop; at most
+    ``max_pending`` calls wait for a thread, further ones fail fast with
+    HasherBusy instead of piling up behind a burst of logins.
+    """
+
+    def __init__(self, context: CryptContext = pwd_context, workers: int = PASSWORD_HASH_WORKERS,
+                 max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.context = context
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def submit(self, fn, *args) -> Future:
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy("Too many password checks in progress, try again later")
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def hash(self, password: str) -> str:
+        return self.submit(self.context.hash, password).result()
+
+    def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        return self.submit(self.context.verify_and_update, password, hashed_password).result()
+
+    async def hash_async(self, password: str) -> str:
+        return await asyncio.wrap_future(self.submit(self.context.hash, password))
+
+    async def verify_and_update_async(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        return await asyncio.wrap_future(self.submit(self.context.verify_and_update, password, hashed_password))
+
+
+password_hasher = PasswordHasher()
+
 def hash_password(password: str) -> str:
     """
     Hashes the given password using bcrypt.
@@ -16,7 +83,7 @@ def hash_password(password: str) -> str:
     Returns:
         str: The hashed password.
     """
-    return pwd_context.hash(password)
+    return password_hasher.hash(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
@@ -29,7 +96,42 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     Returns:
         bool: True if the plain password matches the hashed password, False otherwise.
     """
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_hasher.verify_and_update(plain_password, hashed_password)[0]
+
+def parse_timestamp(value) -> Optional[datetime.datetime]:
+    """
+    Parses the created_at text of a message into a datetime.
+
+    Parameters:
+        value: Text in TIMESTAMP_FORMAT or ISO 8601 (including str(datetime)), or a datetime.
+
+    Returns:
+        datetime: The timestamp, or None if the value can not be parsed.
+    """
+    if isinstance(value, datetime.datetime) or value is None:
+        return value
+    try:
+        return datetime.datetime.strptime(value, TIMESTAMP_FORMAT)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def rewrite_prompt(message: str, tone: str) -> str:
+    """
+    Builds the prompt asking the model to rewrite a message in the given tone.
+
+    Parameters:
+        message: The message to be rewritten.
+        tone: The desired tone for the rewritten message.
+
+    Returns:
+        str: The prompt sent to the model.
+    """
+    return f"Can you return the following message, in a more {tone} tone: {message}"
 
 def ai_rewrite_message(message: str, tone: str = "nice") -> str:
     """
@@ -45,7 +147,7 @@ def ai_rewrite_message(message: str, tone: str = "nice") -> str:
     # Generate text using the GPT-3 model
     response = openai.Completion.create(
         engine="text-davinci-002",
-        prompt=f"Can you return the following message, in a more {tone} tone: {message}",
+        prompt=rewrite_prompt(message, tone),
         temperature=OPENAI_CONFIG["temperature"],
         max_tokens=OPENAI_CONFIG["max_tokens"],
         top_p=OPENAI_CONFIG["top_p"],
@@ -1,41 +1,529 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Response
-from typing import List
+import asyncio
+import datetime
+import json
+import logging
+import time
+from collections import defaultdict, deque
+from fastapi import WebSocket
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+from chat_app import config, metrics
+from chat_app.backplane import Backplane, make_backplane
+from chat_app.db.cache import membership
+
+logger = logging.getLogger(__name__)
+
+
+class Connection:
+    """
+    A WebSocket together with its bounded outbound queue.
+
+    Messages are queued by the manager and written by a dedicated writer task,
+    so a slow client only ever delays its own deliveries.
+    """
+
+    def __init__(self, websocket: WebSocket, user: str, max_queue: int):
+        self.websocket = websocket
+        self.user = user
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.writer: Optional[asyncio.Task] = None
+
+    def offer(self, payload: str) -> bool:
+        """
+        Queue an already serialized payload without waiting.
+
+        Parameters:
+        - payload (str): The JSON text to send.
+
+        Returns:
+        - bool: False if the queue is full and the client is lagging behind.
+        """
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+
+class TokenBucket:
+    """
+    Rate limit handing out tokens in arrival order.
+
+    A caller finding the bucket empty reserves the next token straight away and
+    sleeps until it is due, unless that is further away than it is willing to
+    wait, so that a burst of callers is spread out instead of retrying in lockstep.
+
+    Parameters:
+    - rate: Tokens added per second; 0 disables the limit.
+    - burst: Most tokens the bucket holds.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """
+        Take a token, possibly ahead of time.
+
+        Parameters:
+        - max_wait (float): Longest time in seconds the caller accepts to wait for it.
+
+        Returns:
+        - float: Seconds to wait before using the token, or None if there is none in time.
+        """
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        wait = max(0.0, (1 - self._tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self._tokens -= 1
+        return wait
+
+    async def acquire(self, max_wait: float = float("inf")) -> bool:
+        """
+        Wait for a token.
+
+        Returns:
+        - bool: False if no token would be available within max_wait seconds.
+        """
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+
+class Presence:
+    """
+    Coalesces the joins and leaves of users into one event per chat.
+
+    Changes are collected for ``interval`` seconds and then broadcast as a
+    single ``{"type": "presence", "joined": [...], "left": [...]}`` event per
+    chat. A user leaving and coming back within the interval, as every client
+    does when a worker restarts, cancels out and is not announced at all.
+    """
+
+    def __init__(self, manager: "SocketManager", interval: float = config.WS_PRESENCE_INTERVAL):
+        self.manager = manager
+        self.interval = interval
+        self._pending: Dict[int, Dict[str, bool]] = defaultdict(dict)
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, chat_id: int, user: str, present: bool):
+        """
+        Record that a user joined or left a chat.
+
+        Parameters:
+        - chat_id (int): The ID of the chat.
+        - user (str): Identifier for the user.
+        - present (bool): True if the user joined, False if they left.
+        """
+        pending = self._pending[chat_id]
+        if pending.get(user) is (not present):
+            # Back to how the other members last saw it
+            del pending[user]
+            if not pending:
+                del self._pending[chat_id]
+        else:
+            pending[user] = present
+        if self._task is None and self._pending:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        """
+        Broadcast the pending changes now.
+        """
+        pending, self._pending = self._pending, defaultdict(dict)
+        created_at = datetime.datetime.now().strftime(config.TIMESTAMP_FORMAT)
+        for chat_id, users in pending.items():
+            await self.manager.broadcast({
+                "type": "presence",
+                "chat_id": chat_id,
+                "joined": sorted(user for user, present in users.items() if present),
+                "left": sorted(user for user, present in users.items() if not present),
+                "created_at": created_at,
+            }, chat_id)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.interval)
+        finally:
+            self._task = None
+        await self.flush()
+
 
 class SocketManager:
-    def __init__(self):
-        self.active_connections: List[tuple[WebSocket, str]] = []
+    """
+    Keeps track of the open WebSocket connections, indexed by chat room and by
+    user, so that a message is only fanned out to the members of its chat.
+
+    Outbound events go through a backplane, so that the members connected to
+    other worker processes receive them too.
+
+    New connections are admitted through a token bucket and a cap on the
+    connections of each user, both local to this worker, so that every client
+    reconnecting at once after a restart is spread out over time.
+
+    The chat events received lately are kept for the catch-up of reconnecting
+    clients, see recent_messages().
+    """
 
-    async def connect(self, websocket: WebSocket, user: str):
+    def __init__(self, max_queue: int = config.WS_SEND_QUEUE_SIZE,
+                 send_timeout: float = config.WS_SEND_TIMEOUT,
+                 backplane: Optional[Backplane] = None,
+                 accept_rate: float = config.WS_ACCEPT_RATE,
+                 accept_burst: int = config.WS_ACCEPT_BURST,
+                 accept_max_wait: float = config.WS_ACCEPT_MAX_WAIT,
+                 max_connections_per_user: int = config.WS_MAX_CONNECTIONS_PER_USER,
+                 presence_interval: float = config.WS_PRESENCE_INTERVAL,
+                 replay_seconds: float = config.SYNC_REPLAY_SECONDS,
+                 replay_size: int = config.SYNC_REPLAY_SIZE):
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.backplane = backplane if backplane is not None else make_backplane()
+        self._started = False
+        self.admission = TokenBucket(accept_rate, accept_burst)
+        self.accept_max_wait = accept_max_wait
+        self.max_connections_per_user = max_connections_per_user
+        self.presence = Presence(self, presence_interval)
+        self.replay_seconds = replay_seconds
+        self.recent: Deque[Tuple[float, int, str]] = deque(maxlen=replay_size)
+        self.active_connections: Dict[WebSocket, Connection] = {}
+        self.rooms: Dict[int, Set[WebSocket]] = defaultdict(set)
+        self.users: Dict[str, Set[WebSocket]] = defaultdict(set)
+        # Connections of each user waiting for admission, counted against the per-user cap
+        self.admitting: Dict[str, int] = defaultdict(int)
+        self.subscriptions: Dict[WebSocket, Set[int]] = defaultdict(set)
+        self.evicted = 0
+        self.accepted = 0
+        self.rejected: Dict[str, int] = defaultdict(int)
+        self.accept_seconds = 0.0
+        self.accept_seconds_max = 0.0
+
+    async def start(self):
+        """
+        Start receiving the events published on the backplane.
+        """
+        if not self._started:
+            self._started = True
+            await self.backplane.start(self.deliver)
+
+    def share_membership(self):
+        """
+        Send the friendships and chats created or deleted on this worker to the
+        membership caches of the others; a single process has nothing to share.
+        """
+        if config.BACKPLANE != "memory":
+            membership.publish = self.publish_membership
+
+    def publish_membership(self, change: dict):
+        # Called from the threads running sync endpoints too; backplanes queue thread-safely
+        self.backplane.publish("membership", self._serialize(change))
+
+    async def stop(self):
+        self.presence.cancel()
+        if self._started:
+            self._started = False
+            await self.backplane.stop()
+
+    async def connect(self, websocket: WebSocket, user: str, chat_ids: Iterable[int] = (),
+                      paused: bool = False) -> bool:
         """
         Handle a new WebSocket connection.
 
+        The handshake waits for a token of the admission bucket. A connection
+        that would wait longer than accept_max_wait, or that goes over the
+        connections allowed per user (those still waiting included), is closed
+        straight after being accepted, with a code telling the client whether
+        to retry later (1013) or not (1008).
+
         Parameters:
         - websocket (WebSocket): The WebSocket object representing the connection.
         - user (str): Identifier for the user associated with the connection.
+        - chat_ids (Iterable[int]): Chats the connection is subscribed to straight away.
+        - paused (bool): Queue the events of the chats without sending them until
+          resume() is called, leaving the socket to the caller in the meantime.
+
+        Returns:
+        - bool: False if the connection was turned away.
+        """
+        started = time.monotonic()
+        # Checked before taking a token, so a connection over the cap never uses up admission capacity
+        if len(self.users.get(user, ())) + self.admitting.get(user, 0) >= self.max_connections_per_user:
+            await self._reject(websocket, "too_many_connections", code=1008)
+            return False
+        self.admitting[user] += 1
+        try:
+            if not await self.admission.acquire(self.accept_max_wait):
+                await self._reject(websocket, "rate_limited", code=1013)
+                return False
+            await websocket.accept()
+        finally:
+            self.admitting[user] -= 1
+            if not self.admitting[user]:
+                del self.admitting[user]
+        elapsed = time.monotonic() - started
+        self.accepted += 1
+        self.accept_seconds += elapsed
+        self.accept_seconds_max = max(self.accept_seconds_max, elapsed)
+        metrics.WEBSOCKET_ACCEPT_SECONDS.observe(elapsed)
+        metrics.WEBSOCKET_CONNECTIONS.inc()
+        connection = Connection(websocket, user, self.max_queue)
+        self.active_connections[websocket] = connection
+        self.users[user].add(websocket)
+        for chat_id in chat_ids:
+            self.subscribe(websocket, chat_id)
+        if not paused:
+            self.resume(websocket)
+        return True
+
+    def resume(self, websocket: WebSocket):
+        """
+        Start sending the events queued for a connection opened as paused.
+
+        Parameters:
+        - websocket (WebSocket): The WebSocket object representing the connection.
         """
-        await websocket.accept()
-        self.active_connections.append((websocket, user))
+        connection = self.active_connections.get(websocket)
+        if connection is not None and connection.writer is None:
+            connection.writer = asyncio.create_task(self._write(connection))
 
     def disconnect(self, websocket: WebSocket, user: str):
         """
-        Handle a WebSocket disconnection.
+        Handle a WebSocket disconnection, removing it from every room it joined.
 
         Parameters:
         - websocket (WebSocket): The WebSocket object representing the connection.
         - user (str): Identifier for the user associated with the connection.
         """
-        self.active_connections.remove((websocket, user))
+        for chat_id in list(self.subscriptions.get(websocket, ())):
+            self.unsubscribe(websocket, chat_id)
+        connection = self.active_connections.pop(websocket, None)
+        if connection is not None:
+            metrics.WEBSOCKET_CONNECTIONS.dec()
+            if connection.writer is not None:
+                connection.writer.cancel()
+        self._discard(self.users, user, websocket)
 
-    async def broadcast(self, data: dict):
+    def subscribe(self, websocket: WebSocket, chat_id: int):
         """
-        Broadcast a message to all connected WebSocket clients.
+        Add a connection to the room of a chat.
+
+        Parameters:
+        - websocket (WebSocket): The WebSocket object representing the connection.
+        - chat_id (int): The ID of the chat to join.
+        """
+        connection = self.active_connections.get(websocket)
+        if connection is not None and not self._in_room(connection.user, chat_id):
+            self.presence.update(chat_id, connection.user, True)
+        self.rooms[chat_id].add(websocket)
+        self.subscriptions[websocket].add(chat_id)
+
+    def unsubscribe(self, websocket: WebSocket, chat_id: int):
+        """
+        Remove a connection from the room of a chat.
+
+        Parameters:
+        - websocket (WebSocket): The WebSocket object representing the connection.
+        - chat_id (int): The ID of the chat to leave.
+        """
+        if not self.is_subscribed(websocket, chat_id):
+            return
+        self._discard(self.rooms, chat_id, websocket)
+        self._discard(self.subscriptions, websocket, chat_id)
+        connection = self.active_connections.get(websocket)
+        if connection is not None and not self._in_room(connection.user, chat_id):
+            self.presence.update(chat_id, connection.user, False)
+
+    def is_subscribed(self, websocket: WebSocket, chat_id: int) -> bool:
+        return chat_id in self.subscriptions.get(websocket, ())
+
+    def _in_room(self, user: str, chat_id: int) -> bool:
+        return any(websocket in self.rooms.get(chat_id, ()) for websocket in self.users.get(user, ()))
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"connections": len(self.active_connections), "users": len(self.users),
+                "accepted": self.accepted, "evicted": self.evicted,
+                "rejected_rate_limited": self.rejected["rate_limited"],
+                "rejected_too_many_connections": self.rejected["too_many_connections"],
+                "accept_seconds_avg": self.accept_seconds / self.accepted if self.accepted else 0.0,
+                "accept_seconds_max": self.accept_seconds_max}
+
+    async def broadcast(self, data: dict, chat_id: int):
+        """
+        Broadcast a message to the WebSocket clients subscribed to a chat.
+
+        The payload is serialized once and queued on every recipient; clients
+        whose queue is full are evicted instead of holding up the others.
 
         Parameters:
         - data (dict): The message to be sent as a JSON payload.
+        - chat_id (int): The ID of the chat whose members receive the message.
         """
-        for connection in self.active_connections:
-            await connection[0].send_json(data)
+        await self.publish(f"chat:{chat_id}", data)
 
+    async def send_to_user(self, user: str, data: dict):
+        """
+        Send a message to every open connection of a user.
 
-manager = SocketManager()
+        Parameters:
+        - user (str): Identifier for the user.
+        - data (dict): The message to be sent as a JSON payload.
+        """
+        await self.publish(f"user:{user}", data)
+
+    def send(self, websocket: WebSocket, data: dict):
+        """
+        Queue a message for a single connection, e.g. an error about a frame it sent.
+
+        Parameters:
+        - websocket (WebSocket): The WebSocket object representing the connection.
+        - data (dict): The message to be sent as a JSON payload.
+        """
+        self._fan_out(self._serialize(data), [websocket])
+
+    async def publish(self, channel: str, data: dict):
+        await self.start()
+        self.backplane.publish(channel, self._serialize(data))
+        # Let the writer tasks pick the payload up before the next broadcast.
+        await asyncio.sleep(0)
+
+    def deliver(self, channel: str, payload: str):
+        """
+        Deliver an event from the backplane to the local subscribers of its channel.
+
+        Parameters:
+        - channel (str): "chat:<id>", "user:<name>", or "membership" for membership cache changes.
+        - payload (str): The serialized JSON payload.
+        """
+        kind, _, key = channel.partition(":")
+        if kind == "chat":
+            self.recent.append((time.monotonic(), int(key), payload))
+            self._fan_out(payload, self.rooms.get(int(key), ()))
+        elif kind == "user":
+            self._fan_out(payload, self.users.get(key, ()))
+        elif kind == "membership":
+            membership.apply(json.loads(payload))
+
+    def recent_messages(self, chat_id: int,
+                        since: Union[int, datetime.datetime, None] = None) -> List[str]:
+        """
+        The chat messages this worker received in the last replay_seconds, oldest first.
+
+        Every worker gets the events of every chat from the backplane, so these
+        include messages other workers, or Celery, may not have saved yet.
+
+        Parameters:
+        - chat_id (int): The ID of the chat.
+        - since (datetime): Only the messages sent at or after this time; an
+          ID cursor can not be compared with unsaved messages and keeps them all.
+
+        Returns:
+        - list: The serialized message events.
+        """
+        oldest = time.monotonic() - self.replay_seconds
+        messages = []
+        for received, event_chat_id, payload in self.recent:
+            if received < oldest or event_chat_id != chat_id:
+                continue
+            data = json.loads(payload)
+            if "db_status" not in data or not data.get("sent_at"):
+                continue
+            if isinstance(since, datetime.datetime) and datetime.datetime.fromisoformat(data["sent_at"]) < since:
+                continue
+            messages.append(payload)
+        return messages
 
+    def _fan_out(self, payload: str, websockets: Iterable[WebSocket]):
+        started = time.perf_counter()
+        websockets = list(websockets)
+        for websocket in websockets:
+            connection = self.active_connections.get(websocket)
+            if connection is not None and not connection.offer(payload):
+                self.evict(connection, reason="send queue full")
+        metrics.FANOUT_RECIPIENTS.observe(len(websockets))
+        metrics.FANOUT_SECONDS.observe(time.perf_counter() - started)
+
+    def evict(self, connection: Connection, reason: str):
+        """
+        Drop a connection that can not keep up and close its socket.
+
+        Parameters:
+        - connection (Connection): The lagging connection.
+        - reason (str): Why the connection was dropped, sent as the close reason.
+        """
+        if connection.websocket not in self.active_connections:
+            return
+        logger.warning("Evicting websocket of %s: %s", connection.user, reason)
+        self.evicted += 1
+        metrics.WEBSOCKET_EVICTED.labels(reason).inc()
+        self.disconnect(connection.websocket, connection.user)
+        asyncio.create_task(self._close(connection.websocket, reason))
+
+    async def _write(self, connection: Connection):
+        while True:
+            # Send whatever has piled up in one go, so a busy room costs one
+            # wake-up of the writer rather than one per message.
+            payloads = [await connection.queue.get()]
+            while not connection.queue.empty():
+                payloads.append(connection.queue.get_nowait())
+            try:
+                await asyncio.wait_for(self._send_all(connection.websocket, payloads),
+                                       timeout=self.send_timeout)
+            except asyncio.TimeoutError:
+                self.evict(connection, reason="send timed out")
+                return
+            except Exception:
+                # The client went away; its receive loop will clean up.
+                self.disconnect(connection.websocket, connection.user)
+                return
+
+    @staticmethod
+    async def _send_all(websocket: WebSocket, payloads):
+        for payload in payloads:
+            await websocket.send_text(payload)
+
+    async def _reject(self, websocket: WebSocket, reason: str, code: int):
+        # Accepted first, as a close during the handshake reaches browsers without its code
+        self.rejected[reason] += 1
+        metrics.WEBSOCKET_REJECTED.labels(reason).inc()
+        logger.info("Rejected websocket: %s", reason)
+        try:
+            await websocket.accept()
+            await websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    async def _close(self, websocket: WebSocket, reason: str):
+        try:
+            await asyncio.wait_for(websocket.close(code=1013, reason=reason),
+                                   timeout=self.send_timeout)
+        except Exception:
+            pass
+
+    @staticmethod
+    def _serialize(data: dict) -> str:
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+    @staticmethod
+    def _discard(index: dict, key, value):
+        members = index.get(key)
+        if members is None:
+            return
+        members.discard(value)
+        if not members:
+            del index[key]
+
+
+manager = SocketManager()
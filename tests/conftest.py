@@ -0,0 +1,28 @@
+"""
+Fixtures of the test suite, which runs the app against a throwaway database.
+"""
+import os
+import tempfile
+
+# Set before chat_app is imported, as importing it creates the engines and upgrades the database
+os.environ["CHAT_APP_DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+
+import pytest
+from fastapi.testclient import TestClient
+from chat_app.db.base import SessionLocal
+from chat_app.main import app
+
+
+@pytest.fixture
+def db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as client:
+        yield client
@@ -0,0 +1,63 @@
+"""
+The pages load what they show with a fixed number of queries, however many
+chats and messages there are; a loop querying per chat or per message makes
+the counts below grow.
+"""
+import itertools
+from chat_app.db import crud, schemas
+from chat_app.db.base import count_queries
+
+_names = itertools.count()
+
+
+def make_user(db, prefix: str):
+    return crud.create_user(db, username=f"{prefix}{next(_names)}", password="secret")
+
+
+def add_chats(db, user, chats: int, messages: int):
+    """
+    Give a user chats with new friends, each holding messages from both sides.
+    """
+    chat_ids = []
+    for _ in range(chats):
+        friend = make_user(db, "friend")
+        crud.create_friendship(db, friend_id=friend.id, user_id=user.id)
+        chat = crud.create_chat(db, schemas.ChatCreate(user_id=user.id, friend_id=friend.id))
+        crud.create_messages([{"chat_id": chat.id, "sender_id": (user.id, friend.id)[i % 2],
+                               "message": f"message {i}", "created_at": "01/01/2023, 12:00:00"}
+                              for i in range(messages)])
+        chat_ids.append(chat.id)
+    return chat_ids
+
+
+def login(client, user):
+    response = client.post("/api/login", json={"username": user.username, "password": "secret"})
+    assert response.json()["status"]
+
+
+def page_queries(client, url: str) -> int:
+    # The first request fills the process caches (usernames, memberships)
+    assert client.get(url).status_code == 200
+    with count_queries() as queries:
+        assert client.get(url).status_code == 200
+    return queries.count
+
+
+def test_home_page_queries_do_not_grow_with_chats(client, db):
+    user = make_user(db, "home")
+    add_chats(db, user, chats=2, messages=3)
+    login(client, user)
+    few = page_queries(client, "/")
+
+    add_chats(db, user, chats=20, messages=3)
+    assert page_queries(client, "/") == few
+
+
+def test_chat_page_queries_do_not_grow_with_messages(client, db):
+    user = make_user(db, "page")
+    short_chat, long_chat = add_chats(db, user, chats=2, messages=2)
+    crud.create_messages([{"chat_id": long_chat, "sender_id": user.id, "message": f"more {i}",
+                           "created_at": "01/01/2023, 12:00:00"} for i in range(40)])
+    login(client, user)
+
+    assert page_queries(client, f"/{long_chat}") == page_queries(client, f"/{short_chat}")
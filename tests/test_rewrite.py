@@ -0,0 +1,122 @@
+"""
+The rewrite pipeline against the local FakeBackend: a slow or failing backend
+never holds a message back, the concurrency bounds hold, batches are cut on
+size and time, and the cache serves repeated rewrites until they expire.
+"""
+import asyncio
+import time
+from chat_app.rewrite import BatchingBackend, FakeBackend, MessageRewriter, RewriteCache
+
+
+class RecordingBackend(FakeBackend):
+    """
+    FakeBackend that records the size of each batch and the most calls it had in flight at once.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sizes = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def rewrite(self, message, tone):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await super().rewrite(message, tone)
+        finally:
+            self.in_flight -= 1
+
+    async def rewrite_batch(self, items):
+        self.batch_sizes.append(len(items))
+        return await super().rewrite_batch(items)
+
+
+def upper(message, tone):
+    return message.upper()
+
+
+def test_timeout_falls_back_to_the_original_message():
+    rewriter = MessageRewriter(FakeBackend(latency=0.5, transform=upper), timeout=0.05, enabled=True)
+    started = time.perf_counter()
+    assert asyncio.run(rewriter.rewrite("hello", "friendly")) == "hello"
+    assert time.perf_counter() - started < 0.4
+
+
+def test_failure_falls_back_to_the_original_message():
+    def fail(message, tone):
+        raise RuntimeError("backend down")
+
+    rewriter = MessageRewriter(FakeBackend(transform=fail), enabled=True)
+    assert asyncio.run(rewriter.rewrite("hello", "friendly")) == "hello"
+
+
+def test_concurrency_is_bounded():
+    backend = RecordingBackend(latency=0.02, transform=upper)
+    rewriter = MessageRewriter(backend, max_concurrency=2, enabled=True)
+
+    async def run():
+        return await asyncio.gather(*(rewriter.rewrite(f"message {i}", "friendly") for i in range(8)))
+
+    assert asyncio.run(run()) == [f"MESSAGE {i}" for i in range(8)]
+    assert backend.max_in_flight == 2
+
+
+def test_batches_are_cut_at_max_batch():
+    backend = RecordingBackend(transform=upper)
+    batching = BatchingBackend(backend, window=0.05, max_batch=4)
+
+    async def run():
+        return await asyncio.gather(*(batching.rewrite(f"message {i}", "friendly") for i in range(10)))
+
+    assert asyncio.run(run()) == [f"MESSAGE {i}" for i in range(10)]
+    # Two full batches right away, the rest once the window is over
+    assert backend.batch_sizes == [4, 4, 2]
+
+
+def test_batches_are_cut_after_the_window():
+    backend = RecordingBackend(transform=upper)
+    batching = BatchingBackend(backend, window=0.02, max_batch=16)
+
+    async def run():
+        first = await asyncio.gather(batching.rewrite("a", "friendly"), batching.rewrite("b", "friendly"))
+        await asyncio.sleep(0.05)
+        second = await batching.rewrite("c", "friendly")
+        return first, second
+
+    assert asyncio.run(run()) == (["A", "B"], "C")
+    assert backend.batch_sizes == [2, 1]
+
+
+def test_cache_hits_misses_and_expiry():
+    backend = FakeBackend(transform=upper)
+    cache = RewriteCache(ttl=0.05, params={})
+    rewriter = MessageRewriter(backend, cache=cache, enabled=True)
+
+    async def run():
+        assert await rewriter.rewrite("Hello  world", "friendly") == "HELLO  WORLD"
+        # Same text once normalized: served from the cache
+        assert await rewriter.rewrite("hello world", "friendly") == "HELLO  WORLD"
+        assert backend.calls == 1
+        # Another tone is another entry
+        await rewriter.rewrite("hello world", "formal")
+        assert backend.calls == 2
+        await asyncio.sleep(0.1)
+        await rewriter.rewrite("hello world", "friendly")
+        assert backend.calls == 3
+
+    asyncio.run(run())
+    assert cache.stats() == {"size": 2, "hits": 1, "misses": 3, "shared_hits": 0}
+
+
+def test_cache_evicts_the_least_recently_used_entry():
+    cache = RewriteCache(max_size=2, params={})
+
+    async def run():
+        for message in ("a", "b"):
+            await cache.set(cache.key(message, "friendly"), message.upper())
+        await cache.get(cache.key("a", "friendly"))
+        await cache.set(cache.key("c", "friendly"), "C")
+        return [await cache.get(cache.key(message, "friendly")) for message in ("a", "b", "c")]
+
+    assert asyncio.run(run()) == ["A", None, "C"]